@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger('SpotifyBot.AuthIPC')
+
+# State values older than this are rejected
+STATE_MAX_AGE = 60 * 60
+
+
+def socket_path() -> str:
+    """Path of the Unix socket the bot listens on for authorization codes"""
+    return os.getenv('AUTH_SOCKET_PATH', 'spotify_caches/auth.sock')
+
+
+def _signature(secret: str, payload: str) -> str:
+    return hmac.new(secret.encode(), payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def sign_state(user_id: int, secret: str) -> str:
+    """Build an OAuth state value that ties a login to a Discord user"""
+    payload = f"{user_id}.{int(time.time())}"
+    return f"{payload}.{_signature(secret, payload)}"
+
+
+def verify_state(state: str, secret: str, max_age: int = STATE_MAX_AGE) -> Optional[int]:
+    """Return the Discord user id in a state value, or None if it is forged or stale"""
+    try:
+        user_id, issued_at, signature = state.split('.')
+        payload = f"{user_id}.{issued_at}"
+        if not hmac.compare_digest(signature, _signature(secret, payload)):
+            return None
+        if time.time() - int(issued_at) > max_age:
+            return None
+        return int(user_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def send_auth_code(state: str, code: str, path: Optional[str] = None, timeout: float = 5.0) -> bool:
+    """Hand an authorization code to the bot; True if the bot accepted it"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path or socket_path())
+        sock.sendall(json.dumps({'state': state, 'code': code}).encode() + b'\n')
+        reply = sock.makefile('rb').readline()
+    return reply.strip() == b'ok'
+
+
+class AuthCodeListener:
+    """Receives authorization codes from the callback server over a Unix socket
+
+    Each connection carries one JSON line with ``state`` and ``code``. The
+    handler decides whether to accept it, and the answer is written back
+    as ``ok`` or ``rejected``.
+    """
+    def __init__(self, handler: Callable[[str, str], Awaitable[bool]], path: Optional[str] = None):
+        self.handler = handler
+        self.path = path or socket_path()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        path = Path(self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            path.unlink()
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        logger.info(f"Listening for authorization codes on {self.path}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        accepted = False
+        try:
+            message = json.loads(await asyncio.wait_for(reader.readline(), 5))
+            accepted = await self.handler(message['state'], message['code'])
+        except Exception as e:
+            logger.error(f"Error receiving authorization code: {e}")
+        try:
+            writer.write(b'ok\n' if accepted else b'rejected\n')
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            Path(self.path).unlink(missing_ok=True)
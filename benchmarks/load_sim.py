@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""Offline load simulation of SpotifyManager and the slash commands
+
+Runs the real SpotifyManager, track monitor, live displays and command
+handlers against in-process stand-ins for the Spotify Web API and the
+Discord REST layer, so no accounts or network are needed.
+
+    python benchmarks/load_sim.py --users 1000 --duration 60
+    python benchmarks/load_sim.py --users 10 100 1000 10000
+
+Several user counts are run one after another, each in a fresh process so
+their memory figures are comparable.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord
+from spotipy.exceptions import SpotifyException
+
+import musicboy
+from snapshot_memory import playback_payload
+
+# Distinct tracks the fake catalog cycles through
+CATALOG_SIZE = 5000
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_mb() -> float:
+    """Current resident memory, falling back to the peak where /proc is missing"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Recorder:
+    """Latency samples per operation, safe to feed from worker threads"""
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+
+class FakePlayer:
+    """One simulated user's Spotify player, advancing in real time"""
+    def __init__(self, rng: random.Random, track_seconds: float):
+        self.rng = rng
+        self.track_seconds = track_seconds
+        self.is_playing = True
+        self.volume = 50
+        self.track_number = rng.randrange(CATALOG_SIZE)
+        self.duration = self._duration()
+        # Start somewhere in the middle of a track
+        self.started_at = time.monotonic() - rng.uniform(0, self.duration)
+        # Only changes during the run count towards notification delay
+        self.changed_at: Optional[float] = None
+        self.paused_progress = 0.0
+
+    def _duration(self) -> float:
+        return self.rng.uniform(0.5, 1.5) * self.track_seconds
+
+    def _next(self, at: float):
+        self.track_number = (self.track_number + 1) % CATALOG_SIZE
+        self.duration = self._duration()
+        self.started_at = at
+        self.changed_at = at
+
+    def advance(self, now: float):
+        while self.is_playing and now >= self.started_at + self.duration:
+            self._next(self.started_at + self.duration)
+
+    def progress(self, now: float) -> float:
+        return now - self.started_at if self.is_playing else self.paused_progress
+
+
+class FakeSpotifyAPI:
+    """In-process Web API shared by every simulated user
+
+    Each request sleeps for the configured latency on the calling worker
+    thread, like a real HTTP round trip, and a configurable fraction are
+    answered with 429 and a Retry-After header.
+    """
+    def __init__(self, latency: float, rate_429: float, retry_after: float, track_seconds: float, seed: int):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.track_seconds = track_seconds
+        self.rng = random.Random(seed)
+        self.players: Dict[int, FakePlayer] = {}
+        self.requests = collections.Counter()
+        self.rate_limited = 0
+        self._payloads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def player(self, user_id: int) -> FakePlayer:
+        with self._lock:
+            player = self.players.get(user_id)
+            if player is None:
+                player = self.players[user_id] = FakePlayer(random.Random(self.rng.random()), self.track_seconds)
+            return player
+
+    def request(self, method: str):
+        with self._lock:
+            self.requests[method] += 1
+            limited = self.rng.random() < self.rate_429
+            if limited:
+                self.rate_limited += 1
+            delay = self.latency * self.rng.uniform(0.5, 1.5)
+        time.sleep(delay)
+        if limited:
+            raise SpotifyException(429, -1, "API rate limit exceeded", headers={'Retry-After': str(self.retry_after)})
+
+    def payload(self, track_number: int) -> str:
+        payload = self._payloads.get(track_number)
+        if payload is None:
+            payload = self._payloads[track_number] = playback_payload(track_number)
+        return payload
+
+
+class FakeSpotifyClient:
+    """The subset of spotipy.Spotify the bot calls, backed by FakeSpotifyAPI"""
+    def __init__(self, api: FakeSpotifyAPI, user_id: int):
+        self.api = api
+        self.player = api.player(user_id)
+
+    def current_playback(self):
+        self.api.request('current_playback')
+        now = time.monotonic()
+        self.player.advance(now)
+        # Decode a full response like spotipy does for every request
+        playback = json.loads(self.api.payload(self.player.track_number))
+        playback['item']['duration_ms'] = int(self.player.duration * 1000)
+        playback['progress_ms'] = int(self.player.progress(now) * 1000)
+        playback['is_playing'] = self.player.is_playing
+        playback['device']['volume_percent'] = self.player.volume
+        return playback
+
+    def next_track(self):
+        self.api.request('next_track')
+        self.player._next(time.monotonic())
+
+    def previous_track(self):
+        self.api.request('previous_track')
+        self.player._next(time.monotonic())
+
+    def pause_playback(self):
+        self.api.request('pause_playback')
+        now = time.monotonic()
+        self.player.paused_progress = self.player.progress(now)
+        self.player.is_playing = False
+
+    def start_playback(self):
+        self.api.request('start_playback')
+        self.player.started_at = time.monotonic() - self.player.paused_progress
+        self.player.is_playing = True
+
+    def volume(self, volume_percent: int):
+        self.api.request('volume')
+        self.player.volume = volume_percent
+
+    def _top(self, method: str, limit: int, offset: int, kind: str) -> dict:
+        self.api.request(method)
+        items = []
+        for number in range(offset, offset + limit):
+            track = json.loads(self.api.payload(number))['item']
+            items.append(track if kind == 'tracks' else dict(track['artists'][0], genres=['pop']))
+        return {'items': items, 'next': None}
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        return self._top('current_user_top_tracks', limit, offset, 'tracks')
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        return self._top('current_user_top_artists', limit, offset, 'artists')
+
+
+class FakeMessage:
+    def __init__(self, discord_api: 'FakeDiscord', channel: 'FakeChannel'):
+        self.discord = discord_api
+        self.channel = channel
+        self.id = next(discord_api.message_ids)
+
+    async def edit(self, **kwargs):
+        await self.discord.request('edit')
+        return self
+
+
+class FakeChannel:
+    def __init__(self, discord_api: 'FakeDiscord', user_id: int):
+        self.discord = discord_api
+        self.user_id = user_id
+        self.id = user_id
+
+    async def send(self, **kwargs):
+        await self.discord.request('send')
+        # How long after the track actually changed the user heard about it
+        player = self.discord.spotify.players.get(self.user_id)
+        if player is not None and player.changed_at is not None:
+            self.discord.recorder.record('notification_delay', time.monotonic() - player.changed_at)
+        return FakeMessage(self.discord, self)
+
+
+class FakeDiscord:
+    """Stand-in for the Discord REST calls SpotifyManager makes directly"""
+    def __init__(self, latency: float, spotify: FakeSpotifyAPI, recorder: Recorder):
+        self.latency = latency
+        self.spotify = spotify
+        self.recorder = recorder
+        self.requests = collections.Counter()
+        self.message_ids = iter(range(1, 1 << 62))
+        self.interaction_ids = iter(range(1, 1 << 62))
+
+    async def request(self, kind: str):
+        self.requests[kind] += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def get_user(self, user_id: int):
+        return None
+
+    async def create_dm(self, user):
+        await self.request('create_dm')
+        return FakeChannel(self, user.id)
+
+
+class FakeResponse:
+    def __init__(self, discord_api: FakeDiscord):
+        self.discord = discord_api
+
+    async def defer(self, **kwargs):
+        await self.discord.request('interaction_response')
+
+    async def send_message(self, *args, **kwargs):
+        await self.discord.request('interaction_response')
+
+    async def edit_message(self, **kwargs):
+        await self.discord.request('interaction_response')
+
+
+class FakeFollowup:
+    def __init__(self, discord_api: FakeDiscord, channel: FakeChannel):
+        self.discord = discord_api
+        self.channel = channel
+
+    async def send(self, *args, **kwargs):
+        await self.discord.request('followup')
+        return FakeMessage(self.discord, self.channel)
+
+
+class FakeInteraction:
+    def __init__(self, discord_api: FakeDiscord, user_id: int):
+        self.id = next(discord_api.interaction_ids)
+        self.user = discord.Object(id=user_id)
+        self.created_at = datetime.now(timezone.utc)
+        self.response = FakeResponse(discord_api)
+        self.followup = FakeFollowup(discord_api, FakeChannel(discord_api, user_id))
+        self.discord = discord_api
+
+    async def edit_original_response(self, **kwargs):
+        await self.discord.request('followup')
+
+
+def make_config(args, directory: str) -> musicboy.Config:
+    config = object.__new__(musicboy.Config)
+    config.SPOTIFY_CLIENT_ID = 'load-sim'
+    config.SPOTIFY_CLIENT_SECRET = 'load-sim'
+    config.SPOTIFY_REDIRECT_URI = 'http://localhost:8888/callback'
+    config.SPOTIFY_MAX_CONCURRENCY = args.spotify_concurrency
+    config.MONITOR_POLL_INTERVAL = args.poll_interval
+    config.MONITOR_MAX_IN_FLIGHT = args.max_in_flight
+    config.MONITOR_MAX_INTERVAL = 30.0
+    config.MONITOR_IDLE_MAX_INTERVAL = 120.0
+    # Fake clients only exist in this process, so monitor in-process
+    config.MONITOR_WORKERS = 0
+    config.MONITOR_SOCKET_PATH = os.path.join(directory, 'monitor.sock')
+    config.PLAYBACK_CACHE_TTL = 3.0
+    config.SPOTIFY_RATE_LIMIT = args.rate_limit
+    config.SPOTIFY_RATE_BURST = int(args.rate_limit * 2)
+    config.DATABASE_PATH = os.path.join(directory, 'load_sim.db')
+    config.METRICS_PORT = 0
+    config.DISCORD_RATE_LIMIT = args.discord_rate_limit
+    config.DISCORD_RATE_BURST = int(args.discord_rate_limit)
+    return config
+
+
+async def command_tree(manager: musicboy.SpotifyManager) -> discord.app_commands.CommandTree:
+    """Register the real slash commands on a bot that never connects"""
+    bot = musicboy.SpotifyBot.__new__(musicboy.SpotifyBot)
+    discord.Client.__init__(bot, intents=discord.Intents.none())
+    bot.tree = discord.app_commands.CommandTree(bot)
+    bot.config = manager.config
+    bot.spotify_manager = manager
+
+    async def sync(*args, **kwargs):
+        return []
+
+    bot.tree.sync = sync
+    await bot.register_commands()
+    return bot.tree
+
+
+async def measure_loop_lag(recorder: Recorder, stop: asyncio.Event, interval: float = 0.05):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        recorder.record('loop_lag', time.perf_counter() - started - interval)
+
+
+async def drive_interactions(args, manager, tree, discord_api: FakeDiscord, recorder: Recorder,
+                             users: List[int], stop: asyncio.Event):
+    """Press buttons and run commands at the configured rates, without waiting on them"""
+    rng = random.Random(args.seed + 1)
+    tasks = set()
+
+    async def timed(name: str, operation):
+        started = time.perf_counter()
+        try:
+            await operation
+        except Exception as e:
+            recorder.record(f"{name}_error", 0.0)
+            logging.getLogger('LoadSim').debug(f"{name} failed: {e}")
+        else:
+            recorder.record(name, time.perf_counter() - started)
+
+    def launch(name: str, operation):
+        task = asyncio.create_task(timed(name, operation))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    nowplaying = tree.get_command('nowplaying')
+    stats = tree.get_command('stats')
+    total_rate = args.press_rate + args.stats_rate + args.nowplaying_rate
+    while not stop.is_set() and total_rate > 0:
+        await asyncio.sleep(rng.expovariate(total_rate))
+        user_id = rng.choice(users)
+        pick = rng.uniform(0, total_rate)
+        if pick < args.nowplaying_rate:
+            launch('nowplaying', nowplaying.callback(FakeInteraction(discord_api, user_id)))
+        elif pick < args.nowplaying_rate + args.stats_rate:
+            launch('stats_all', stats.callback(FakeInteraction(discord_api, user_id), time_range='all'))
+        else:
+            view = manager.live_displays.displays.get(user_id)
+            if view is None:
+                continue
+            button = rng.choice((view.skip, view.play_pause, view.volume_up))
+            launch(f"button_{button.label.lower().replace('/', '_').replace(' ', '_')}",
+                   button.callback(FakeInteraction(discord_api, user_id)))
+    if tasks:
+        # Let operations in flight finish, but never hold up the report for long
+        _, pending = await asyncio.wait(set(tasks), timeout=30)
+        for task in pending:
+            task.cancel()
+
+
+async def simulate(args) -> dict:
+    recorder = Recorder()
+    spotify = FakeSpotifyAPI(args.spotify_latency, args.rate_429, args.retry_after, args.track_seconds, args.seed)
+    discord_api = FakeDiscord(args.discord_latency, spotify, recorder)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['AUTH_SOCKET_PATH'] = os.path.join(directory, 'auth.sock')
+        manager = musicboy.SpotifyManager(make_config(args, directory), discord_api)
+        clients = {}
+
+        async def get_client(user_id: int, force_refresh: bool = False):
+            client = clients.get(user_id)
+            if client is None:
+                client = clients[user_id] = FakeSpotifyClient(spotify, user_id)
+            return client
+
+        # Tokens and OAuth are not part of the simulation
+        manager.get_client = get_client
+        await manager.start()
+        tree = await command_tree(manager)
+
+        users = list(range(1, args.users + 1))
+        rss_before = rss_mb()
+        started = time.monotonic()
+        for user_id in users:
+            await manager.start_track_monitor(user_id)
+            # Spread first polls over one interval, as a restart would
+            manager.monitor.schedule(user_id, random.uniform(0, args.poll_interval))
+
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(measure_loop_lag(recorder, stop))
+        driver = asyncio.create_task(drive_interactions(args, manager, tree, discord_api, recorder, users, stop))
+        await asyncio.sleep(args.duration)
+        stop.set()
+        await asyncio.gather(lag_task, driver)
+        elapsed = time.monotonic() - started
+
+        result = {
+            'users': args.users,
+            'seconds': elapsed,
+            'rss_mb': rss_mb(),
+            'rss_growth_mb': rss_mb() - rss_before,
+            'monitor': manager.monitor.stats(),
+            'spotify_requests': dict(spotify.requests),
+            'spotify_429': spotify.rate_limited,
+            'discord_requests': dict(discord_api.requests),
+            'outbox': manager.outbox.stats(),
+            'latency': {
+                name: {
+                    'count': len(values),
+                    'per_second': len(values) / elapsed,
+                    'p50_ms': percentile(values, 0.5) * 1000,
+                    'p99_ms': percentile(values, 0.99) * 1000,
+                }
+                for name, values in sorted(recorder.samples.items())
+            },
+        }
+        await manager.close()
+    return result
+
+
+def report(result: dict):
+    print(f"\n=== {result['users']} users, {result['seconds']:.0f}s ===")
+    print(f"RSS {result['rss_mb']:.1f} MB (+{result['rss_growth_mb']:.1f} MB during run)")
+    monitor = result['monitor']
+    print(
+        f"Monitor: {monitor['polls_total']} polls, {monitor['poll_errors']} errors, "
+        f"lag avg {monitor['lag_avg'] * 1000:.1f} ms"
+    )
+    print(f"{'operation':<24}{'count':>9}{'per sec':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stats in result['latency'].items():
+        print(
+            f"{name:<24}{stats['count']:>9}{stats['per_second']:>10.1f}"
+            f"{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+        )
+    spotify_total = sum(result['spotify_requests'].values())
+    print(f"Spotify requests: {spotify_total} ({spotify_total / result['seconds']:.1f}/s), {result['spotify_429']} answered 429")
+    for method, count in sorted(result['spotify_requests'].items()):
+        print(f"  {method:<28}{count:>8}")
+    discord_total = sum(result['discord_requests'].values())
+    print(f"Discord requests: {discord_total} ({discord_total / result['seconds']:.1f}/s)")
+    for kind, count in sorted(result['discord_requests'].items()):
+        print(f"  {kind:<28}{count:>8}")
+    outbox = result['outbox']
+    print(
+        f"Outbox: {outbox['merged']} edits merged, {outbox['superseded']} notifications superseded, "
+        f"{outbox['pending']} still queued"
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[100])
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds to run each simulation")
+    parser.add_argument('--track-seconds', type=float, default=180.0, help="mean track length")
+    parser.add_argument('--spotify-latency', type=float, default=0.08, help="mean Spotify request latency")
+    parser.add_argument('--discord-latency', type=float, default=0.05, help="mean Discord request latency")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of Spotify requests answered 429")
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--press-rate', type=float, default=2.0, help="button presses per second")
+    parser.add_argument('--stats-rate', type=float, default=0.5, help="/stats all commands per second")
+    parser.add_argument('--nowplaying-rate', type=float, default=1.0, help="/nowplaying commands per second")
+    parser.add_argument('--poll-interval', type=float, default=10.0)
+    parser.add_argument('--max-in-flight', type=int, default=64)
+    parser.add_argument('--spotify-concurrency', type=int, default=64)
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help="Spotify requests per second allowed")
+    parser.add_argument('--discord-rate-limit', type=float, default=40.0, help="Discord requests per second allowed")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if len(args.users) > 1:
+        # One process per size so memory and loop lag are not shared
+        base = [arg for arg in sys.argv[1:] if arg != '--json']
+        for users in args.users:
+            command = [sys.executable, os.path.abspath(__file__)] + replace_users(base, users)
+            if args.json:
+                command.append('--json')
+            subprocess.run(command, check=True)
+        return
+
+    args.users = args.users[0]
+    result = asyncio.run(simulate(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
+
+
+def replace_users(argv: List[str], users: int) -> List[str]:
+    """Rewrite --users N M ... to a single count"""
+    rewritten = []
+    skipping = False
+    for arg in argv:
+        if arg == '--users':
+            skipping = True
+            continue
+        if skipping and not arg.startswith('--'):
+            continue
+        skipping = False
+        rewritten.append(arg)
+    return rewritten + ['--users', str(users)]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Compare memory held per monitored user by raw playback JSON and snapshots
+
+Every user keeps the last playback state they were polled with, the way
+the playback cache and live displays do. Responses are decoded from JSON
+per user, as spotipy hands back a fresh dict for every request.
+
+    python benchmarks/snapshot_memory.py --users 5000 --tracks 500
+"""
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import PlaybackSnapshot, TrackCatalog
+
+MARKETS = [f"{a}{b}" for a in "ABCDEFGHIJKLMN" for b in "ABCDEFGHIJKLM"]
+
+
+def playback_payload(track_number: int) -> str:
+    """A current_playback response shaped like the real Web API one"""
+    artist = {
+        'external_urls': {'spotify': f"https://open.spotify.com/artist/artist{track_number}"},
+        'href': f"https://api.spotify.com/v1/artists/artist{track_number}",
+        'id': f"artist{track_number}",
+        'name': f"Artist {track_number}",
+        'type': 'artist',
+        'uri': f"spotify:artist:artist{track_number}",
+    }
+    album = {
+        'album_type': 'album',
+        'artists': [artist],
+        'available_markets': MARKETS,
+        'external_urls': {'spotify': f"https://open.spotify.com/album/album{track_number}"},
+        'href': f"https://api.spotify.com/v1/albums/album{track_number}",
+        'id': f"album{track_number}",
+        'images': [
+            {'height': size, 'width': size, 'url': f"https://i.scdn.co/image/{track_number}-{size}"}
+            for size in (640, 300, 64)
+        ],
+        'name': f"Album {track_number}",
+        'release_date': '2020-01-01',
+        'release_date_precision': 'day',
+        'total_tracks': 12,
+        'type': 'album',
+        'uri': f"spotify:album:album{track_number}",
+    }
+    item = {
+        'album': album,
+        'artists': [artist],
+        'available_markets': MARKETS,
+        'disc_number': 1,
+        'duration_ms': 200000 + track_number,
+        'explicit': False,
+        'external_ids': {'isrc': f"USRC{track_number:08d}"},
+        'external_urls': {'spotify': f"https://open.spotify.com/track/track{track_number}"},
+        'href': f"https://api.spotify.com/v1/tracks/track{track_number}",
+        'id': f"track{track_number}",
+        'is_local': False,
+        'name': f"Track {track_number}",
+        'popularity': 50,
+        'preview_url': None,
+        'track_number': 1,
+        'type': 'track',
+        'uri': f"spotify:track:track{track_number}",
+    }
+    return json.dumps({
+        'device': {
+            'id': 'device', 'is_active': True, 'is_private_session': False,
+            'is_restricted': False, 'name': 'Desktop', 'type': 'Computer',
+            'volume_percent': 50,
+        },
+        'shuffle_state': False,
+        'repeat_state': 'off',
+        'timestamp': 1700000000000,
+        'context': None,
+        'progress_ms': 1000,
+        'item': item,
+        'currently_playing_type': 'track',
+        'actions': {'disallows': {'resuming': True}},
+        'is_playing': True,
+    })
+
+
+def measure(users: int, payloads: list, keep) -> int:
+    """Bytes still allocated after every user holds one playback state"""
+    tracemalloc.start()
+    held = [keep(json.loads(payloads[user % len(payloads)])) for user in range(users)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--tracks', type=int, default=500, help="distinct tracks being played")
+    args = parser.parse_args()
+
+    payloads = [playback_payload(number) for number in range(args.tracks)]
+    raw = measure(args.users, payloads, lambda playback: playback)
+    catalog = TrackCatalog()
+    compact = measure(args.users, payloads, lambda playback: PlaybackSnapshot.from_api(playback, catalog))
+
+    print(f"{args.users} users, {args.tracks} distinct tracks")
+    print(f"raw JSON dicts:    {raw / 1024:10.1f} KiB  {raw / args.users:8.0f} B/user")
+    print(f"PlaybackSnapshot:  {compact / 1024:10.1f} KiB  {compact / args.users:8.0f} B/user")
+    print(f"reduction:         {raw / max(compact, 1):10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+
+logger = logging.getLogger('SpotifyBot.Cache')
+
+
+class TTLCache:
+    """Async cache with per-entry expiry and single-flight fetches
+
+    Concurrent misses for the same key share one in-flight fetch instead
+    of each calling the backend. Invalidating a key drops its entry and
+    detaches any fetch already running, so callers that arrive afterwards
+    always see fresh data.
+
+    An entry fetched with ``stale`` seconds of grace keeps being served
+    for that long after it expires, while a single background fetch
+    replaces it.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # key -> (expires_at, stale_until, value)
+        self._entries: Dict[Hashable, Tuple[float, float, Any]] = {}
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self._revalidations: Set[asyncio.Task] = set()
+        self._prune_at = 1024
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Return a cached value if it is still fresh, without fetching"""
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[2]
+        return None
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None, stale: float = 0.0):
+        """Store a value fetched elsewhere"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, expires_at + stale, value)
+        if len(self._entries) > self._prune_at:
+            self.prune()
+
+    def prune(self):
+        """Drop entries that can no longer be served, even stale"""
+        now = time.monotonic()
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[1] > now}
+        self._prune_at = max(1024, 2 * len(self._entries))
+
+    def invalidate(self, key: Hashable):
+        """Forget a key so the next get fetches it again"""
+        self._entries.pop(key, None)
+        self._in_flight.pop(key, None)
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                  ttl: Optional[float] = None, stale: float = 0.0) -> Any:
+        """Return the cached value for key, fetching it once on a miss"""
+        entry = self._entries.get(key)
+        if entry:
+            now = time.monotonic()
+            if entry[0] > now:
+                self.hits += 1
+                return entry[2]
+            if entry[1] > now:
+                self.stale_hits += 1
+                self._revalidate(key, fetch, ttl, stale)
+                return entry[2]
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        return await self._fetch(key, fetch, ttl, stale)
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                     ttl: Optional[float], stale: float) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await fetch()
+        except BaseException as e:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Waiters see the exception; stop asyncio warning about it
+                future.exception()
+            raise
+
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+            self.put(key, value, ttl, stale)
+        future.set_result(value)
+        return value
+
+    def _revalidate(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                    ttl: Optional[float], stale: float):
+        """Refresh a stale entry in the background unless a fetch is running"""
+        if key in self._in_flight:
+            return
+        task = asyncio.create_task(self._fetch_quietly(key, fetch, ttl, stale))
+        self._revalidations.add(task)
+        task.add_done_callback(self._revalidations.discard)
+
+    async def _fetch_quietly(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                             ttl: Optional[float], stale: float):
+        try:
+            await self._fetch(key, fetch, ttl, stale)
+        except Exception as e:
+            # The stale value keeps being served until its grace period ends
+            logger.warning(f"Background refresh of {key!r} failed: {e}")
+
+    def close(self):
+        """Cancel background refreshes"""
+        for task in self._revalidations:
+            task.cancel()
+        self._revalidations.clear()
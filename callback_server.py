@@ -1,39 +1,13 @@
 #!/usr/bin/env python3
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import urllib.parse
 import logging
-from pathlib import Path
+from auth_ipc import send_auth_code
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('CallbackServer')
 
-class CallbackHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        try:
-            logger.info(f"Received callback with path: {self.path}")
-            parsed_path = urllib.parse.urlparse(self.path)
-            if parsed_path.path == '/callback':
-                # Extract the authorization code
-                params = urllib.parse.parse_qs(parsed_path.query)
-                logger.info(f"Query parameters: {params}")
-                auth_code = params.get('code', [None])[0]
-                
-                if auth_code:
-                    # Save the auth code to a file
-                    cache_dir = Path("spotify_caches")
-                    cache_dir.mkdir(exist_ok=True)
-                    
-                    with open(cache_dir / "latest_auth_code.txt", "w") as f:
-                        f.write(auth_code)
-                    
-                    logger.info(f"Saved auth code: {auth_code[:10]}...")
-                    
-                    # Send success response
-                    self.send_response(200)
-                    self.send_header('Content-type', 'text/html')
-                    self.end_headers()
-                    
-                    html = """
+SUCCESS_HTML = """
     <html>
         <head>
             <title>Spotify Authentication Successful</title>
@@ -61,10 +35,40 @@ class CallbackHandler(BaseHTTPRequestHandler):
         </body>
     </html>
     """
-                    self.wfile.write(html.encode())
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        try:
+            parsed_path = urllib.parse.urlparse(self.path)
+            logger.info(f"Received callback with path: {parsed_path.path}")
+            if parsed_path.path == '/callback':
+                # Extract the authorization code and the state naming the Discord user
+                params = urllib.parse.parse_qs(parsed_path.query)
+                auth_code = params.get('code', [None])[0]
+                state = params.get('state', [None])[0]
+                
+                if auth_code and state:
+                    # Hand the code to the bot, which checks the state and exchanges it
+                    try:
+                        accepted = send_auth_code(state, auth_code)
+                    except OSError as e:
+                        logger.error(f"Could not reach the bot: {e}")
+                        self.send_error(503, "The bot is not running, please try again shortly")
+                        return
+                    
+                    if not accepted:
+                        logger.error("Bot rejected the authorization state")
+                        self.send_error(400, "This login link has expired, please request a new one")
+                        return
+                    
+                    # Send success response
+                    self.send_response(200)
+                    self.send_header('Content-type', 'text/html')
+                    self.end_headers()
+                    self.wfile.write(SUCCESS_HTML.encode())
                     logger.info("Processed callback successfully")
                 else:
-                    logger.error("No authorization code received")
+                    logger.error(f"No authorization code received: {params.get('error', ['missing code or state'])[0]}")
                     self.send_error(400, "No authorization code received")
             else:
                 logger.error(f"Invalid callback path: {parsed_path.path}")
@@ -73,8 +77,14 @@ class CallbackHandler(BaseHTTPRequestHandler):
             logger.error(f"Error in callback: {e}")
             self.send_error(500)
 
+class CallbackServer(ThreadingHTTPServer):
+    """Handles each callback on its own thread so many users can log in at once"""
+    daemon_threads = True
+    # Let a burst of logins queue instead of being refused
+    request_queue_size = 128
+
 def run():
-    server = HTTPServer(('localhost', 8888), CallbackHandler)
+    server = CallbackServer(('localhost', 8888), CallbackHandler)
     logger.info("Starting callback server on port 8888...")
     server.serve_forever()
 
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+
+
+class SpotifyError(Exception):
+    """Base exception for Spotify-related errors"""
+    pass
+
+
+class RetryableSpotifyError(SpotifyError):
+    """Exception for errors that can be retried"""
+    pass
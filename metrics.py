@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger('SpotifyBot.Metrics')
+
+# Seconds; covers fast cache hits up to slow Spotify and Discord calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def drain(self) -> list:
+        """Take what was recorded so far so another process can merge it"""
+        return []
+
+    def merge(self, samples: list):
+        """Add samples drained from the same metric in another process"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def drain(self) -> list:
+        with self._lock:
+            values, self._values = self._values, {}
+        return [[list(key), value] for key, value in values.items()]
+
+    def merge(self, samples: list):
+        with self._lock:
+            for key, value in samples:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0.0) + value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Value read from a callback each time metrics are collected"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels):
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._functions.items())
+        samples = []
+        for key, function in items:
+            try:
+                value = function()
+            except Exception as e:
+                logger.warning(f"Error reading gauge {self.name}: {e}")
+                continue
+            samples.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return samples
+
+
+class CounterFunction(Gauge):
+    """Running total kept by another object and read from a callback"""
+    kind = 'counter'
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (per-bucket counts with a final +Inf slot, sum)
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe how long the body of a with block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def drain(self) -> list:
+        with self._lock:
+            values, self._values = self._values, {}
+        return [[list(key), counts, total[0]] for key, (counts, total) in values.items()]
+
+    def merge(self, samples: list):
+        with self._lock:
+            for key, counts, total in samples:
+                entry = self._values.get(tuple(key))
+                if entry is None:
+                    entry = self._values[tuple(key)] = ([0] * (len(self.buckets) + 1), [0.0])
+                for index, count in enumerate(counts):
+                    entry[0][index] += count
+                entry[1][0] += total
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text format"""
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+    def drain(self) -> Dict[str, list]:
+        """Take everything counters and histograms recorded since the last drain"""
+        drained = {}
+        for name, metric in self._metrics.items():
+            samples = metric.drain()
+            if samples:
+                drained[name] = samples
+        return drained
+
+    def merge(self, drained: Dict[str, list]):
+        """Add metrics drained in another process, such as a monitor worker"""
+        for name, samples in drained.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge(samples)
+
+
+REGISTRY = Registry()
+
+SPOTIFY_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'melodymaster_spotify_request_seconds', "Spotify Web API request latency", ['method']
+))
+SPOTIFY_ERRORS = REGISTRY.register(Counter(
+    'melodymaster_spotify_errors_total', "Spotify Web API errors by HTTP status", ['method', 'status']
+))
+SPOTIFY_RATE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'melodymaster_spotify_rate_wait_seconds', "Time spent waiting on the rate governor", ['priority']
+))
+GET_CLIENT_SECONDS = REGISTRY.register(Histogram(
+    'melodymaster_get_client_seconds', "get_client time by phase (lock_wait, load, refresh)", ['phase']
+))
+POLL_LAG_SECONDS = REGISTRY.register(Histogram(
+    'melodymaster_poll_lag_seconds', "How late scheduled polls start", ['scheduler']
+))
+DISCORD_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'melodymaster_discord_request_seconds', "Discord message send and edit latency", ['action']
+))
+DISCORD_OUTBOX_DROPPED = REGISTRY.register(Counter(
+    'melodymaster_discord_outbox_dropped_total', "Discord calls merged into or replaced by a newer one", ['reason']
+))
+COMMAND_SECONDS = REGISTRY.register(Histogram(
+    'melodymaster_command_seconds', "Slash command latency from interaction to completion", ['command']
+))
+SHARD_EVENTS = REGISTRY.register(Counter(
+    'melodymaster_shard_events_total', "Gateway shard connects, disconnects, readies and resumes", ['shard', 'event']
+))
+SHARD_LATENCY_SECONDS = REGISTRY.register(Gauge(
+    'melodymaster_shard_latency_seconds', "Gateway heartbeat latency per shard", ['shard']
+))
+# Filled in with callbacks by the components that own the values
+STATE = REGISTRY.register(Gauge(
+    'melodymaster_state', "Current size of bot queues and caches", ['name']
+))
+CACHE_EVENTS = REGISTRY.register(CounterFunction(
+    'melodymaster_cache_events_total', "Cache hits, misses, coalesced and stale reads", ['cache', 'event']
+))
+SPOTIFY_GOVERNOR_EVENTS = REGISTRY.register(CounterFunction(
+    'melodymaster_spotify_governor_events_total', "Rate governor grants, requests queued for a token and Retry-After pauses", ['event']
+))
+
+
+class MetricsServer:
+    """Serves the registry at /metrics over plain HTTP on a local port"""
+    def __init__(self, port: int, host: str = '127.0.0.1', registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Drain the headers; the request has no body
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                body = self.registry.render().encode()
+                status = '200 OK'
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                body = b'Not Found\n'
+                status = '404 Not Found'
+                content_type = 'text/plain'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
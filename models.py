@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import hashlib
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+
+class TrackSnapshot:
+    """The fields of a Spotify track the bot shows, parsed once per track
+
+    Snapshots are immutable by convention and shared between every user
+    listening to the same track.
+    """
+    __slots__ = ('id', 'uri', 'name', 'artist', 'artist_id', 'album', 'thumbnail', 'duration_ms', 'digest')
+
+    def __init__(self, id: Optional[str], uri: Optional[str], name: str, artist: str,
+                 album: str, thumbnail: Optional[str], duration_ms: int,
+                 artist_id: Optional[str] = None):
+        self.id = id
+        self.uri = uri
+        self.name = name
+        self.artist = artist
+        self.artist_id = artist_id
+        self.album = album
+        self.thumbnail = thumbnail
+        self.duration_ms = duration_ms
+        # Identifies the static part of the Now Playing embed
+        self.digest = hashlib.sha1(
+            '\x1f'.join(map(str, (name, artist, album, thumbnail, duration_ms))).encode()
+        ).hexdigest()
+
+    @classmethod
+    def from_api(cls, item: dict) -> 'TrackSnapshot':
+        """Parse a track (or podcast episode) object from the Web API"""
+        artists = item.get('artists') or []
+        # Episodes carry a show where tracks carry an album
+        album = item.get('album') or item.get('show') or {}
+        images = album.get('images') or item.get('images') or []
+        return cls(
+            # Local files have no id, so fall back to the uri
+            item.get('id') or item.get('uri'),
+            item.get('uri'),
+            item['name'],
+            artists[0]['name'] if artists else album.get('publisher', 'Unknown'),
+            album.get('name', 'Unknown'),
+            images[0]['url'] if images else None,
+            item.get('duration_ms') or 0,
+            artists[0].get('id') if artists else None,
+        )
+
+    def __repr__(self) -> str:
+        return f"TrackSnapshot({self.id!r}, {self.name!r})"
+
+
+class ArtistSnapshot:
+    """The fields of a Spotify artist the bot uses"""
+    __slots__ = ('id', 'name', 'genres')
+
+    def __init__(self, id: str, name: str, genres: Tuple[str, ...]):
+        self.id = id
+        self.name = name
+        self.genres = genres
+
+    @classmethod
+    def from_api(cls, item: dict) -> 'ArtistSnapshot':
+        return cls(item['id'], item['name'], tuple(item.get('genres') or ()))
+
+    def __repr__(self) -> str:
+        return f"ArtistSnapshot({self.id!r}, {self.name!r})"
+
+
+class PlaybackSnapshot:
+    """A user's playback state at the moment it was fetched"""
+    __slots__ = ('track', 'is_playing', 'progress_ms', 'volume_percent')
+
+    def __init__(self, track: Optional[TrackSnapshot], is_playing: bool,
+                 progress_ms: Optional[int], volume_percent: Optional[int]):
+        self.track = track
+        self.is_playing = is_playing
+        self.progress_ms = progress_ms
+        self.volume_percent = volume_percent
+
+    @classmethod
+    def from_api(cls, playback: Optional[dict], tracks: 'TrackCatalog') -> Optional['PlaybackSnapshot']:
+        """Parse a current_playback response, or None when nothing is active"""
+        if not playback:
+            return None
+        item = playback.get('item')
+        device = playback.get('device') or {}
+        return cls(
+            tracks.get(item) if item else None,
+            bool(playback.get('is_playing')),
+            playback.get('progress_ms'),
+            device.get('volume_percent'),
+        )
+
+    @property
+    def remaining(self) -> Optional[float]:
+        """Seconds left in the current track, if known"""
+        if self.track is None or self.progress_ms is None:
+            return None
+        return max(self.track.duration_ms - self.progress_ms, 0) / 1000
+
+    def __repr__(self) -> str:
+        return f"PlaybackSnapshot({self.track!r}, is_playing={self.is_playing})"
+
+
+class TrackCatalog:
+    """Bounded LRU of track snapshots keyed by track id
+
+    Parsing goes through here so a track playing for many users is held
+    once, and its static fields are extracted only the first time it is
+    seen.
+    """
+    def __init__(self, max_tracks: int = 4096):
+        self.max_tracks = max_tracks
+        self._tracks: 'OrderedDict[Hashable, TrackSnapshot]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def get(self, item: dict) -> TrackSnapshot:
+        """Return the snapshot for a track object, parsing it on a miss"""
+        key = item.get('id') or item.get('uri')
+        if key is None:
+            return TrackSnapshot.from_api(item)
+
+        track = self._tracks.get(key)
+        if track is not None:
+            self._tracks.move_to_end(key)
+            self.hits += 1
+            return track
+
+        self.misses += 1
+        track = TrackSnapshot.from_api(item)
+        self._tracks[key] = track
+        if len(self._tracks) > self.max_tracks:
+            self._tracks.popitem(last=False)
+        return track
+
+    def add(self, track: TrackSnapshot) -> TrackSnapshot:
+        """Cache an already parsed snapshot, returning the cached copy if there is one"""
+        key = track.id or track.uri
+        if key is None:
+            return track
+        cached = self._tracks.get(key)
+        if cached is not None:
+            self._tracks.move_to_end(key)
+            self.hits += 1
+            return cached
+        self.misses += 1
+        self._tracks[key] = track
+        if len(self._tracks) > self.max_tracks:
+            self._tracks.popitem(last=False)
+        return track
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import signal
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+from musicboy import Config, SpotifyManager
+from metrics import REGISTRY
+from models import PlaybackSnapshot
+from scheduler import PollScheduler
+from workers import MonitorPool, encode_message, encode_playback
+
+logger = logging.getLogger('SpotifyBot.MonitorWorker')
+
+
+class WorkerSpotifyManager(SpotifyManager):
+    """SpotifyManager for a monitor worker process
+
+    Polls the users the bot process hands it and reports track changes
+    back instead of talking to Discord. The bot process stays the only
+    writer of user records and the one that refreshes tokens ahead of
+    time; the worker re-reads a token from the shared database before
+    refreshing it itself.
+    """
+    def __init__(self, config: Config, index: int, writer: asyncio.StreamWriter):
+        self.index = index
+        self.writer = writer
+        super().__init__(config)
+
+    def _create_monitor(self):
+        return PollScheduler(
+            self._poll_track_changes,
+            interval=self.config.MONITOR_POLL_INTERVAL,
+            max_in_flight=self.config.MONITOR_MAX_IN_FLIGHT,
+            name=f'Monitor worker {self.index}'
+        )
+
+    def _send(self, *fields):
+        if not self.writer.is_closing():
+            self.writer.write(encode_message(*fields))
+
+    async def _load_token(self, user_id: int) -> Optional[dict]:
+        token_info = self.token_store.get(user_id)
+        if token_info is None or self._token_needs_refresh(token_info):
+            # Usually the bot process has already refreshed it or the user just connected
+            token_info = await self._run_blocking(self.token_store.reload, user_id)
+        return token_info
+
+    def _schedule_token_refresh(self, user_id: int, token_info: dict):
+        # The bot process refreshes tokens ahead of time; workers only refresh on demand
+        pass
+
+    def _track_changed(self, user_id: int, playback: PlaybackSnapshot):
+        self.last_tracks[user_id] = playback.track.id
+        self._send('track', user_id, *encode_playback(playback))
+
+    async def _require_reauth(self, user_id: int):
+        self.clients.pop(user_id, None)
+        self.monitor.remove(user_id)
+        self.history.finish(user_id)
+        self._send('reauth', user_id)
+
+    async def start(self):
+        await self.token_store.load()
+        await self.history.load()
+
+    def watch(self, user_id: int, last_track_id: Optional[str], delay: Optional[float]):
+        """Start polling a user, or move their next poll"""
+        if last_track_id and user_id not in self.last_tracks:
+            self.last_tracks[user_id] = last_track_id
+        if user_id in self.monitor:
+            self.idle_polls.pop(user_id, None)
+        self.monitor.start()
+        self.monitor.schedule(user_id, delay)
+
+    def unwatch(self, user_id: int):
+        """Stop polling a user and record their current play"""
+        self.monitor.remove(user_id)
+        self.idle_polls.pop(user_id, None)
+        self.last_tracks.pop(user_id, None)
+        self.history.finish(user_id)
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(MonitorPool.STATS_INTERVAL)
+            # Metrics are sent as deltas so a restarted worker cannot count twice
+            self._send('stats', self.monitor.stats(), REGISTRY.drain())
+
+
+async def serve(index: int, path: str, config: Config):
+    """Poll for the bot process until it closes the connection"""
+    reader, writer = await asyncio.open_unix_connection(path)
+    manager = WorkerSpotifyManager(config, index, writer)
+    await manager.start()
+    manager._send('hello', index)
+    reporter = asyncio.create_task(manager.report_stats())
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            kind, *fields = json.loads(line)
+            if kind == 'watch':
+                manager.watch(*fields)
+            elif kind == 'unwatch':
+                manager.unwatch(*fields)
+    finally:
+        reporter.cancel()
+        await manager.close()
+        writer.close()
+    logger.info(f"Monitor worker {index} stopped")
+
+
+def _log_to_own_file(index: int):
+    """Swap the bot's log file handler for one only this worker writes to
+
+    Every process rotating the same bot.log would lose or garble lines.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, RotatingFileHandler):
+            root.removeHandler(handler)
+            handler.close()
+            worker_handler = RotatingFileHandler(
+                f'bot-worker-{index}.log',
+                maxBytes=handler.maxBytes,
+                backupCount=handler.backupCount,
+                encoding='utf-8'
+            )
+            worker_handler.setFormatter(handler.formatter)
+            root.addHandler(worker_handler)
+
+
+def run(index: int, path: str, config: Config):
+    """Entry point of a monitor worker process"""
+    _log_to_own_file(index)
+    # Ctrl+C goes to the whole process group; let the bot shut workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(serve(index, path, config))
+    except Exception as e:
+        logger.error(f"Monitor worker {index} failed: {e}")
+        raise
@@ -3,17 +3,41 @@ import os
 import discord
 from discord.ext import commands, tasks
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+from spotipy.cache_handler import CacheHandler
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
 import logging
 from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
-import json
 import asyncio
+import functools
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, List
 from enum import Enum
 from pathlib import Path
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from auth_ipc import AuthCodeListener, sign_state, verify_state
+from cache import TTLCache
+from errors import RetryableSpotifyError
+from metrics import (
+    CACHE_EVENTS, COMMAND_SECONDS, GET_CLIENT_SECONDS, SHARD_EVENTS, SHARD_LATENCY_SECONDS, SPOTIFY_ERRORS,
+    SPOTIFY_GOVERNOR_EVENTS, SPOTIFY_RATE_WAIT_SECONDS, SPOTIFY_REQUEST_SECONDS, STATE, MetricsServer
+)
+from models import ArtistSnapshot, PlaybackSnapshot, TrackCatalog, TrackSnapshot
+from outbound import DiscordOutbox
+from playlists import PlaylistBuilder
+from ratelimit import RateGovernor
+from recommender import Recommender
+from rendering import NowPlayingRenderer, render_stats_page
+from scheduler import PollScheduler
+from storage import HistoryStore, TokenStore, UserStore
+from workers import MonitorPool
 
 # Initialize logging
 logging.basicConfig(
@@ -31,30 +55,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger('SpotifyBot')
 
-def create_progress_bar(progress_ms: int, duration_ms: int) -> tuple[str, str, str]:
-    """Create a progress bar with timestamps"""
-    progress_percent = (progress_ms / duration_ms) if duration_ms > 0 else 0
-    bar_length = 20
-    filled_length = int(progress_percent * bar_length)
-    bar = '¦' * filled_length + '¦' * (bar_length - filled_length)
-    current_time = f"{progress_ms // 60000}:{(progress_ms // 1000 % 60):02d}"
-    total_time = f"{duration_ms // 60000}:{(duration_ms // 1000 % 60):02d}"
-    return bar, current_time, total_time
-
-class SpotifyError(Exception):
-    """Base exception for Spotify-related errors"""
-    pass
-
-class RetryableSpotifyError(SpotifyError):
-    """Exception for errors that can be retried"""
-    pass
-
 class TimeRange(Enum):
     """Time ranges for Spotify statistics"""
     SHORT_TERM = 'short_term'
     MEDIUM_TERM = 'medium_term'
     LONG_TERM = 'long_term'
 
+    @property
+    def label(self) -> str:
+        return {
+            'short_term': "Last 4 Weeks",
+            'medium_term': "Last 6 Months",
+            'long_term': "Last Year",
+        }[self.value]
+
 class Config:
     """Configuration handler for the bot"""
     def __init__(self):
@@ -79,6 +93,34 @@ class Config:
         self.SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
         self.SPOTIFY_REDIRECT_URI = os.getenv('SPOTIFY_REDIRECT_URI')
         self.CHANNEL_ID = int(os.getenv('CHANNEL_ID'))
+        
+        # Maximum number of Spotify requests in flight at once
+        self.SPOTIFY_MAX_CONCURRENCY = int(os.getenv('SPOTIFY_MAX_CONCURRENCY', '16'))
+        # Seconds between track monitor polls, and how many may run at once
+        self.MONITOR_POLL_INTERVAL = float(os.getenv('MONITOR_POLL_INTERVAL', '10'))
+        self.MONITOR_MAX_IN_FLIGHT = int(os.getenv('MONITOR_MAX_IN_FLIGHT', '8'))
+        # Longest wait between polls while a track plays, and while nothing does
+        self.MONITOR_MAX_INTERVAL = float(os.getenv('MONITOR_MAX_INTERVAL', '30'))
+        self.MONITOR_IDLE_MAX_INTERVAL = float(os.getenv('MONITOR_IDLE_MAX_INTERVAL', '120'))
+        # Worker processes that run the track monitor; 0 polls in the bot process
+        self.MONITOR_WORKERS = int(os.getenv('MONITOR_WORKERS', '0'))
+        self.MONITOR_SOCKET_PATH = os.getenv('MONITOR_SOCKET_PATH', 'spotify_caches/monitor.sock')
+        # Seconds a fetched playback state is shared between callers
+        self.PLAYBACK_CACHE_TTL = float(os.getenv('PLAYBACK_CACHE_TTL', '3'))
+        # App-wide Spotify request budget (requests per second and burst size)
+        self.SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', '10'))
+        self.SPOTIFY_RATE_BURST = int(os.getenv('SPOTIFY_RATE_BURST', '20'))
+        # SQLite database holding monitored users and their last tracks
+        self.DATABASE_PATH = os.getenv('DATABASE_PATH', 'spotify_caches/melodymaster.db')
+        # Local port serving Prometheus metrics at /metrics; 0 turns it off
+        self.METRICS_PORT = int(os.getenv('METRICS_PORT', '8889'))
+        # App-wide Discord request budget, kept under Discord's global limit of 50/s
+        self.DISCORD_RATE_LIMIT = float(os.getenv('DISCORD_RATE_LIMIT', '40'))
+        self.DISCORD_RATE_BURST = int(os.getenv('DISCORD_RATE_BURST', '40'))
+        # Gateway shards; 0 uses the count Discord recommends
+        self.SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+        # Seconds between shard IDENTIFYs in each of Discord's concurrency buckets
+        self.SHARD_IDENTIFY_INTERVAL = float(os.getenv('SHARD_IDENTIFY_INTERVAL', '5'))
 
 class PlaybackControls(discord.ui.View):
     def __init__(self, spotify_manager: 'SpotifyManager', user_id: int, message: discord.Message = None):
@@ -86,77 +128,34 @@ class PlaybackControls(discord.ui.View):
         self.spotify_manager = spotify_manager
         self.user_id = user_id
         self.message = message
-        self.update_task = None
-        self.is_updating = False
-
-    async def start_periodic_updates(self):
-        """Start periodic updates of the now playing message"""
-        if not self.is_updating:
-            self.is_updating = True
-            while self.is_updating:
-                try:
-                    if self.message:
-                        await self.update_display()
-                    await asyncio.sleep(10)  # Update every 10 seconds
-                except Exception as e:
-                    logger.error(f"Error in periodic update: {e}")
-                    self.is_updating = False
-                    break
-
-    async def stop_periodic_updates(self):
-        """Stop periodic updates"""
-        self.is_updating = False
+        self.created_at = time.monotonic()
+        # Digest of the last embed sent, used to skip edits that change nothing
+        self.last_digest: Optional[str] = None
 
-    async def update_display(self):
+    async def update_display(self, force: bool = False):
         """Update the now playing message with current track info"""
         try:
-            sp = await self.spotify_manager.get_client(self.user_id)
-            current_track = sp.current_user_playing_track()
-            
-            if not current_track or not current_track.get('item'):
-                return
-            
-            track = current_track['item']
-            embed = discord.Embed(
-                title="Now Playing",
-                color=discord.Color.green(),
-                timestamp=datetime.now(timezone.utc)
-            )
-            
-            embed.add_field(
-                name="Track",
-                value=f"**{track['name']}**",
-                inline=False
-            )
-            embed.add_field(
-                name="Artist",
-                value=track['artists'][0]['name'],
-                inline=True
-            )
-            embed.add_field(
-                name="Album",
-                value=track['album']['name'],
-                inline=True
-            )
-            
-            if current_track['progress_ms'] is not None:
-                progress = current_track['progress_ms']
-                duration = track['duration_ms']
-                bar, current_time, total_time = create_progress_bar(progress, duration)
-                embed.add_field(
-                    name="Progress",
-                    value=f"`{bar}` {current_time}/{total_time}",
-                    inline=False
-                )
-            
-            if track['album']['images']:
-                embed.set_thumbnail(url=track['album']['images'][0]['url'])
-            
-            await self.message.edit(embed=embed, view=self)
-            
+            await self.refresh(force=force)
         except Exception as e:
             logger.error(f"Error updating display: {e}")
 
+    async def refresh(self, playback: Optional[PlaybackSnapshot] = None, force: bool = False,
+                      background: bool = False):
+        """Render the playback state into the message, raising on Discord errors"""
+        if not self.message:
+            return
+        if playback is None:
+            playback = await self.spotify_manager.get_playback(self.user_id)
+        
+        if not playback or not playback.track:
+            return
+            
+        embed, digest = self.spotify_manager.renderer.render(playback)
+        if digest == self.last_digest and not force:
+            return
+        await self.spotify_manager.outbox.edit(self.message, embed=embed, view=self, background=background)
+        self.last_digest = digest
+
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         """Check if the user is authorized to use these controls"""
         if interaction.user.id != self.user_id:
@@ -164,255 +163,819 @@ class PlaybackControls(discord.ui.View):
             return False
         return True
 
+    async def _reply(self, interaction: discord.Interaction, content: str):
+        """Answer a button press privately
+
+        Presses are deferred before calling Spotify, which can take longer
+        than the 3 seconds Discord allows for a response.
+        """
+        await self.spotify_manager.outbox.followup(interaction, content, ephemeral=True)
+
     @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary, emoji="\N{BLACK LEFT-POINTING TRIANGLE}", row=0)
     async def previous_track(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
         try:
-            sp = await self.spotify_manager.get_client(self.user_id)
-            sp.previous_track()
-            await interaction.response.send_message("Previous track", ephemeral=True)
+            await self.spotify_manager.control(self.user_id, 'previous_track')
+            self.spotify_manager.poll_soon(self.user_id)
+            await self._reply(interaction, "Previous track")
             await asyncio.sleep(1)  # Wait for Spotify to update
             await self.update_display()
         except Exception as e:
             logger.error(f"Previous track error: {e}")
-            await interaction.response.send_message("Failed to skip to previous track", ephemeral=True)
+            await self._reply(interaction, "Failed to skip to previous track")
 
     @discord.ui.button(label="Play/Pause", style=discord.ButtonStyle.primary, emoji="\N{BLACK RIGHT-POINTING TRIANGLE}", row=0)
     async def play_pause(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
         try:
-            sp = await self.spotify_manager.get_client(self.user_id)
-            current_playback = sp.current_playback()
-            if current_playback and current_playback['is_playing']:
-                sp.pause_playback()
-                await interaction.response.send_message("Playback paused", ephemeral=True)
+            current_playback = await self.spotify_manager.get_playback(self.user_id)
+            if current_playback and current_playback.is_playing:
+                await self.spotify_manager.control(self.user_id, 'pause_playback')
+                await self._reply(interaction, "Playback paused")
                 button.emoji = "\N{BLACK RIGHT-POINTING TRIANGLE}"
             else:
-                sp.start_playback()
-                await interaction.response.send_message("Playback resumed", ephemeral=True)
+                await self.spotify_manager.control(self.user_id, 'start_playback')
+                await self._reply(interaction, "Playback resumed")
                 button.emoji = "\N{BLACK RIGHT-POINTING DOUBLE TRIANGLE WITH VERTICAL BAR}"
-            await self.update_display()
+            self.spotify_manager.poll_soon(self.user_id)
+            await self.update_display(force=True)
         except Exception as e:
             logger.error(f"Play/Pause error: {e}")
-            await interaction.response.send_message("Failed to toggle playback", ephemeral=True)
+            await self._reply(interaction, "Failed to toggle playback")
 
     @discord.ui.button(label="Skip", style=discord.ButtonStyle.secondary, emoji="\N{BLACK RIGHT-POINTING TRIANGLE}", row=0)
     async def skip(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
         try:
-            sp = await self.spotify_manager.get_client(self.user_id)
-            sp.next_track()
-            await interaction.response.send_message("Next track", ephemeral=True)
+            await self.spotify_manager.control(self.user_id, 'next_track')
+            self.spotify_manager.poll_soon(self.user_id)
+            await self._reply(interaction, "Next track")
             await asyncio.sleep(1)  # Wait for Spotify to update
             await self.update_display()
         except Exception as e:
             logger.error(f"Next track error: {e}")
-            await interaction.response.send_message("Failed to skip track", ephemeral=True)
+            await self._reply(interaction, "Failed to skip track")
 
     @discord.ui.button(label="Volume Down", style=discord.ButtonStyle.secondary, emoji="\N{DOWNWARDS BLACK ARROW}", row=1)
     async def volume_down(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
         try:
-            sp = await self.spotify_manager.get_client(self.user_id)
-            current_playback = sp.current_playback()
+            current_playback = await self.spotify_manager.get_playback(self.user_id)
             if current_playback:
-                current_volume = current_playback['device']['volume_percent']
+                current_volume = current_playback.volume_percent
                 new_volume = max(0, current_volume - 10)
-                sp.volume(new_volume)
-                await interaction.response.send_message(f"Volume decreased to {new_volume}%", ephemeral=True)
+                await self.spotify_manager.control(self.user_id, 'volume', new_volume)
+                await self._reply(interaction, f"Volume decreased to {new_volume}%")
         except Exception as e:
             logger.error(f"Volume down error: {e}")
-            await interaction.response.send_message("Failed to lower volume", ephemeral=True)
+            await self._reply(interaction, "Failed to lower volume")
 
     @discord.ui.button(label="Volume Up", style=discord.ButtonStyle.secondary, emoji="\N{UPWARDS BLACK ARROW}", row=1)
     async def volume_up(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
         try:
-            sp = await self.spotify_manager.get_client(self.user_id)
-            current_playback = sp.current_playback()
+            current_playback = await self.spotify_manager.get_playback(self.user_id)
             if current_playback:
-                current_volume = current_playback['device']['volume_percent']
+                current_volume = current_playback.volume_percent
                 new_volume = min(100, current_volume + 10)
-                sp.volume(new_volume)
-                await interaction.response.send_message(f"Volume set to {new_volume}%", ephemeral=True)
+                await self.spotify_manager.control(self.user_id, 'volume', new_volume)
+                await self._reply(interaction, f"Volume set to {new_volume}%")
         except Exception as e:
             logger.error(f"Volume up error: {e}")
-            await interaction.response.send_message("Failed to increase volume", ephemeral=True)
+            await self._reply(interaction, "Failed to increase volume")
+
+class LiveDisplayManager:
+    """Keeps the newest now playing message of each user up to date
+
+    Only one display per user is live. Registering a new one retires the
+    previous message, and a single task refreshes every live display from
+    one playback fetch per user.
+    """
+    UPDATE_INTERVAL = 10
+    # Interaction followups can only be edited for 15 minutes
+    MAX_AGE = 15 * 60
+
+    def __init__(self, spotify_manager: 'SpotifyManager'):
+        self.spotify_manager = spotify_manager
+        self.displays: Dict[int, PlaybackControls] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._retiring: set = set()
+
+    def __len__(self) -> int:
+        return len(self.displays)
+
+    async def register(self, view: PlaybackControls):
+        """Make a view the live display for its user, retiring the previous one"""
+        previous = self.displays.get(view.user_id)
+        self.displays[view.user_id] = view
+        if previous is not None and previous is not view:
+            # Stripping the old buttons is background traffic; don't wait on it
+            task = asyncio.create_task(self.retire(previous))
+            self._retiring.add(task)
+            task.add_done_callback(self._retiring.discard)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def retire(self, view: PlaybackControls, remove_controls: bool = True):
+        """Stop updating a view and, if possible, strip its buttons"""
+        if self.displays.get(view.user_id) is view:
+            del self.displays[view.user_id]
+        view.stop()
+        if remove_controls and view.message:
+            try:
+                await self.spotify_manager.outbox.edit(view.message, view=None, background=True)
+            except discord.HTTPException:
+                pass
+
+    async def close(self):
+        """Stop the refresh task"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for task in self._retiring:
+            task.cancel()
+        self.displays.clear()
+
+    async def _run(self):
+        while self.displays:
+            await asyncio.sleep(self.UPDATE_INTERVAL)
+            await asyncio.gather(*(self._refresh(view) for view in list(self.displays.values())))
+
+    async def _refresh(self, view: PlaybackControls):
+        if time.monotonic() - view.created_at > self.MAX_AGE:
+            await self.retire(view)
+            return
+        try:
+            playback = await self.spotify_manager.get_playback(view.user_id, background=True)
+            await view.refresh(playback, background=True)
+        except discord.HTTPException as e:
+            if e.status in (401, 403, 404):
+                # Message deleted or interaction token expired
+                await self.retire(view, remove_controls=False)
+            else:
+                logger.error(f"Error updating live display for user {view.user_id}: {e}")
+        except Exception as e:
+            logger.error(f"Error updating live display for user {view.user_id}: {e}")
+
+class DMChannelCache:
+    """LRU cache of DM channels keyed by Discord user id
+
+    Channels come from the gateway cache when the user is known, and are
+    otherwise opened with a single create_dm call. Entries are dropped
+    when Discord answers 403 or 404 for them. Messages go out through
+    the outbox, one route per user. DM channels belong to no shard, so
+    this works the same whichever shard the user was last seen on.
+    """
+    def __init__(self, bot: Optional[discord.Client], outbox: DiscordOutbox, max_size: int = 10000):
+        self.bot = bot
+        self.outbox = outbox
+        self.max_size = max_size
+        self._channels: 'OrderedDict[int, discord.DMChannel]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    async def get(self, user_id: int) -> discord.DMChannel:
+        """Return the DM channel for a user, opening it if needed"""
+        channel = self._lookup(user_id)
+        if channel is None:
+            channel = await self._open(user_id)
+        return channel
+
+    def _lookup(self, user_id: int) -> Optional[discord.DMChannel]:
+        """Find a user's DM channel without calling Discord"""
+        channel = self._channels.get(user_id)
+        if channel is not None:
+            self._channels.move_to_end(user_id)
+            self.hits += 1
+            return channel
+
+        self.misses += 1
+        user = self.bot.get_user(user_id)
+        channel = user.dm_channel if user else None
+        if channel is not None:
+            self._store(user_id, channel)
+        return channel
+
+    async def _open(self, user_id: int) -> discord.DMChannel:
+        channel = await self.bot.create_dm(self.bot.get_user(user_id) or discord.Object(id=user_id))
+        self._store(user_id, channel)
+        return channel
+
+    def _store(self, user_id: int, channel: discord.DMChannel):
+        self._channels[user_id] = channel
+        if len(self._channels) > self.max_size:
+            self._channels.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._channels.pop(user_id, None)
+
+    async def _send_now(self, user_id: int, **kwargs) -> discord.Message:
+        channel = self._channels.get(user_id)
+        if channel is None:
+            # Forgotten while this send was queued
+            channel = await self._open(user_id)
+        try:
+            return await channel.send(**kwargs)
+        except (discord.Forbidden, discord.NotFound):
+            self.invalidate(user_id)
+            raise
+
+    async def send(self, user_id: int, background: bool = False, supersede=None, **kwargs) -> Optional[discord.Message]:
+        """Send a DM, forgetting the channel if Discord refuses it
+
+        Returns None if a newer message with the same supersede key
+        replaced this one before it went out.
+        """
+        if self._lookup(user_id) is None:
+            # Opening the channel is a request of its own
+            await self.outbox.request(
+                ('dm', user_id), functools.partial(self._open, user_id), action='create_dm', background=background
+            )
+        # Share the channel's bucket with edits to messages already in it
+        channel = self._channels.get(user_id)
+        return await self.outbox.request(
+            ('channel', channel.id) if channel is not None else ('dm', user_id),
+            functools.partial(self._send_now, user_id),
+            background=background,
+            supersede=supersede,
+            **kwargs
+        )
+
+class TokenCacheHandler(CacheHandler):
+    """Lets SpotifyOAuth read and save a user's token through the TokenStore"""
+    def __init__(self, token_store: TokenStore, user_id: int):
+        self.token_store = token_store
+        self.user_id = user_id
+
+    def get_cached_token(self) -> Optional[dict]:
+        return self.token_store.get(self.user_id)
+
+    def save_token_to_cache(self, token_info: dict):
+        self.token_store.save(self.user_id, token_info)
 
 class SpotifyManager:
     """Manages Spotify authentication and interactions"""
+    # The background refresher renews tokens this many seconds before they
+    # expire; get_client only refreshes inline inside the shorter margin
+    TOKEN_REFRESH_AHEAD = 600
+    TOKEN_REFRESH_MARGIN = 120
+    TOKEN_REFRESH_CONCURRENCY = 4
+    # Seconds before retrying a refresh that failed for a transient reason
+    TOKEN_REFRESH_RETRY = 60
+    # Poll this long after a track is predicted to end, or after a skip
+    TRACK_END_MARGIN = 1.0
+    SKIP_POLL_DELAY = 1.5
+    # Retries for rate-limited or failed interactive calls, and the longest
+    # Retry-After worth waiting for while a user waits on a response
+    MAX_RETRIES = 2
+    MAX_RETRY_AFTER = 10
+    # Seconds top tracks and artists stay fresh for each time range; a
+    # stale list is served for as long again while it is refetched
+    TOP_ITEMS_TTL = {
+        TimeRange.SHORT_TERM.value: 60 * 60,
+        TimeRange.MEDIUM_TERM.value: 6 * 60 * 60,
+        TimeRange.LONG_TERM.value: 24 * 60 * 60,
+    }
+
     def __init__(self, config: Config, bot: Optional['SpotifyBot'] = None):
         self.config = config
         self.bot = bot
         self.token_locks = defaultdict(asyncio.Lock)
         self.cache_dir = Path("spotify_caches")
         self.cache_dir.mkdir(exist_ok=True)
-        self.track_monitor_tasks: Dict[int, asyncio.Task] = {}
         self.last_tracks: Dict[int, str] = {}
+        self.tracks = TrackCatalog()
+        # With monitor workers every process gets an equal share of the Spotify budget
+        processes = config.MONITOR_WORKERS + 1
+        self.governor = RateGovernor(
+            config.SPOTIFY_RATE_LIMIT / processes,
+            max(1, config.SPOTIFY_RATE_BURST // processes)
+        )
+        self.monitor = self._create_monitor()
+        # Consecutive polls that found nothing playing, used for backoff
+        self.idle_polls: Dict[int, int] = defaultdict(int)
+        self.live_displays = LiveDisplayManager(self)
+        self.outbox = DiscordOutbox(config.DISCORD_RATE_LIMIT, config.DISCORD_RATE_BURST)
+        self.dm_channels = DMChannelCache(bot, self.outbox)
+        self.renderer = NowPlayingRenderer()
+        self.playback_cache = TTLCache(ttl=config.PLAYBACK_CACHE_TTL)
+        # Users whose playback is being fetched at background priority
+        self.background_fetches: set = set()
+        self.results = TTLCache(ttl=self.TOP_ITEMS_TTL[TimeRange.SHORT_TERM.value])
+        self.user_store = UserStore(config.DATABASE_PATH)
+        self.history = HistoryStore(config.DATABASE_PATH)
+        self.recommender = Recommender(self)
+        self._register_gauges()
+        self.token_store = TokenStore(config.DATABASE_PATH, legacy_dir=self.cache_dir)
+        # Token exchanges started by the callback server, kept until they finish
+        self.auth_tasks: set = set()
+        # Track notifications waiting in the outbox, so polls never wait on Discord
+        self.notify_tasks: set = set()
+        self.auth_listener = AuthCodeListener(self._receive_auth_code)
+        # Min-heap of token expiry times, refreshed ahead of time
+        self.token_refresher = PollScheduler(
+            self._refresh_due_token,
+            interval=self.TOKEN_REFRESH_RETRY,
+            jitter=0.05,
+            max_in_flight=self.TOKEN_REFRESH_CONCURRENCY,
+            name='Token refresher'
+        )
+        self.http_session = self._create_http_session()
+        self.oauth_managers: Dict[int, SpotifyOAuth] = {}
+        self.clients: Dict[int, spotipy.Spotify] = {}
+        # Blocking spotipy calls run here so they never stall the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.SPOTIFY_MAX_CONCURRENCY,
+            thread_name_prefix='spotify'
+        )
 
-    def _create_oauth(self, user_id: int) -> SpotifyOAuth:
-        """Create a SpotifyOAuth instance for the given user"""
-        return SpotifyOAuth(
-            client_id=self.config.SPOTIFY_CLIENT_ID,
-            client_secret=self.config.SPOTIFY_CLIENT_SECRET,
-            redirect_uri=self.config.SPOTIFY_REDIRECT_URI,
-            scope=" ".join([
-                "user-read-currently-playing",
-                "user-top-read",
-                "user-read-recently-played",
-                "playlist-modify-public",
-                "playlist-modify-private",
-                "user-read-playback-state",
-                "user-modify-playback-state"
-            ]),
-            cache_path=str(self.cache_dir / f'cache-{user_id}'),
-            open_browser=False
+    def _create_monitor(self):
+        """Poll users in this process, or in monitor worker processes"""
+        config = self.config
+        if config.MONITOR_WORKERS:
+            return MonitorPool(
+                config.MONITOR_WORKERS,
+                config.MONITOR_SOCKET_PATH,
+                config,
+                self._receive_track_change,
+                self._require_reauth,
+                self.last_tracks,
+                self.tracks,
+                interval=config.MONITOR_POLL_INTERVAL,
+                rate=self.governor.rate
+            )
+        return PollScheduler(
+            self._poll_track_changes,
+            interval=config.MONITOR_POLL_INTERVAL,
+            max_in_flight=config.MONITOR_MAX_IN_FLIGHT
+        )
+
+    def _register_gauges(self):
+        """Expose queue and cache sizes and cache and governor counters on the metrics endpoint"""
+        gauges = {
+            'monitored_users': lambda: len(self.monitor),
+            'monitor_queue_depth': lambda: self.monitor.queue_depth,
+            'monitor_in_flight': lambda: self.monitor.in_flight,
+            'live_displays': lambda: len(self.live_displays),
+            'spotify_rate_waiting': lambda: self.governor.waiting,
+            'playback_cache_entries': lambda: len(self.playback_cache),
+            'dm_channels_cached': lambda: len(self.dm_channels),
+            'discord_outbox_pending': lambda: len(self.outbox),
+            'tokens_loaded': lambda: len(self.token_store),
+        }
+        for name, function in gauges.items():
+            STATE.set_function(function, name=name)
+        caches = {
+            'playback': self.playback_cache,
+            'top_items': self.results,
+            'dm_channels': self.dm_channels,
+            'tracks': self.tracks,
+            'recommender_candidates': self.recommender.candidates,
+            'recommender_results': self.recommender.results,
+        }
+        for cache_name, cache in caches.items():
+            for event in ('hits', 'misses', 'coalesced', 'stale_hits'):
+                if hasattr(cache, event):
+                    CACHE_EVENTS.set_function(functools.partial(getattr, cache, event), cache=cache_name, event=event)
+        for event in ('granted', 'throttled', 'pauses'):
+            SPOTIFY_GOVERNOR_EVENTS.set_function(functools.partial(getattr, self.governor, event), event=event)
+
+    def _create_http_session(self) -> requests.Session:
+        """Create the pooled HTTP session shared by all Spotify clients"""
+        session = requests.Session()
+        # Only connection errors are retried here; 429 and 5xx responses
+        # surface to call() so the rate governor can handle them
+        retry = Retry(
+            total=3,
+            connect=None,
+            read=False,
+            # urllib3 would otherwise sleep on Retry-After for 429 and 503 itself
+            status=0,
+            respect_retry_after_header=False,
+            raise_on_status=False,
+            allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+            backoff_factor=0.3
         )
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.config.SPOTIFY_MAX_CONCURRENCY,
+            max_retries=retry
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _create_oauth(self, user_id: int) -> SpotifyOAuth:
+        """Get the SpotifyOAuth instance for the given user, creating it once"""
+        sp_oauth = self.oauth_managers.get(user_id)
+        if sp_oauth is None:
+            sp_oauth = SpotifyOAuth(
+                client_id=self.config.SPOTIFY_CLIENT_ID,
+                client_secret=self.config.SPOTIFY_CLIENT_SECRET,
+                redirect_uri=self.config.SPOTIFY_REDIRECT_URI,
+                scope=" ".join([
+                    "user-read-currently-playing",
+                    "user-top-read",
+                    "user-read-recently-played",
+                    "playlist-modify-public",
+                    "playlist-modify-private",
+                    "user-read-playback-state",
+                    "user-modify-playback-state"
+                ]),
+                cache_handler=TokenCacheHandler(self.token_store, user_id),
+                open_browser=False,
+                requests_session=self.http_session
+            )
+            self.oauth_managers[user_id] = sp_oauth
+        return sp_oauth
+
+    def get_authorize_url(self, user_id: int) -> str:
+        """Build a Spotify login URL whose state identifies the Discord user"""
+        state = sign_state(user_id, self.config.SPOTIFY_CLIENT_SECRET)
+        return self._create_oauth(user_id).get_authorize_url(state=state)
 
-    async def check_auth_code(self, user_id: int) -> Optional[dict]:
-        """Check for and process any new authorization code"""
-        temp_file = self.cache_dir / "latest_auth_code.txt"
+    async def _receive_auth_code(self, state: str, auth_code: str) -> bool:
+        """Accept a code from the callback server if its state is genuine"""
+        user_id = verify_state(state, self.config.SPOTIFY_CLIENT_SECRET)
+        if user_id is None:
+            logger.warning("Rejected authorization code with an invalid state")
+            return False
+        logger.info(f"Received authorization code for user {user_id}")
+        task = asyncio.create_task(self.complete_auth(user_id, auth_code))
+        self.auth_tasks.add(task)
+        task.add_done_callback(self.auth_tasks.discard)
+        return True
+
+    async def complete_auth(self, user_id: int, auth_code: str) -> Optional[dict]:
+        """Exchange a user's authorization code, then start their monitor and welcome them"""
         try:
-            if temp_file.exists():
-                auth_code = temp_file.read_text().strip()
-                if auth_code:
-                    sp_oauth = self._create_oauth(user_id)
-                    token_info = sp_oauth.get_access_token(auth_code, as_dict=True)
-                    
-                    cache_path = self.cache_dir / f'cache-{user_id}'
-                    with open(cache_path, 'w') as f:
-                        json.dump(token_info, f)
-                    
-                    temp_file.unlink()
-                    await self.start_track_monitor(user_id)
-                    await self._send_success_message(user_id)
-                    return token_info
+            async with self.token_locks[user_id]:
+                # SpotifyOAuth saves the new token through the token store
+                sp_oauth = self._create_oauth(user_id)
+                token_info = await self._run_blocking(
+                    sp_oauth.get_access_token, auth_code, as_dict=True, check_cache=False
+                )
+                self._schedule_token_refresh(user_id, token_info)
+            
+            await self.start_track_monitor(user_id)
+            await self._send_success_message(user_id)
+            return token_info
         except Exception as e:
-            logger.error(f"Error processing auth code: {e}")
+            logger.error(f"Error processing auth code for user {user_id}: {e}")
         return None
 
     async def _send_success_message(self, user_id: int):
         """Send success message to user after successful authentication"""
         if self.bot:
             try:
-                user = await self.bot.fetch_user(user_id)
-                if user:
-                    dm_channel = await user.create_dm()
-                    embed = discord.Embed(
-                        title="? Successfully Connected!",
-                        description=(
-                            "Your Spotify account has been connected! "
-                            "I'll now send you updates when your music changes.\n\n"
-                            "**Available Commands:**\n"
-                            " `/nowplaying` - Show current track with controls\n"
-                            " `/stats` - View your listening statistics\n"
-                            " `/recommendations` - Get music recommendations\n"
-                            " `/playlist` - Create custom playlists\n"
-                            " `/toggle_monitor` - Turn track notifications on/off"
-                        ),
-                        color=discord.Color.green(),
-                        timestamp=datetime.now(timezone.utc)
-                    )
-                    embed.set_footer(text="You can use these commands in our DMs!")
-                    await dm_channel.send(embed=embed)
+                embed = discord.Embed(
+                    title="? Successfully Connected!",
+                    description=(
+                        "Your Spotify account has been connected! "
+                        "I'll now send you updates when your music changes.\n\n"
+                        "**Available Commands:**\n"
+                        " `/nowplaying` - Show current track with controls\n"
+                        " `/stats` - View your listening statistics\n"
+                        " `/recommendations` - Get music recommendations\n"
+                        " `/playlist` - Create custom playlists\n"
+                        " `/toggle_monitor` - Turn track notifications on/off"
+                    ),
+                    color=discord.Color.green(),
+                    timestamp=datetime.now(timezone.utc)
+                )
+                embed.set_footer(text="You can use these commands in our DMs!")
+                await self.dm_channels.send(user_id, embed=embed)
             except Exception as e:
                 logger.error(f"Error sending success message: {e}")
 
+    def _token_needs_refresh(self, token_info: dict) -> bool:
+        """Check whether a token is expired or about to expire"""
+        return token_info['expires_at'] - time.time() < self.TOKEN_REFRESH_MARGIN
+
+    async def _load_token(self, user_id: int) -> Optional[dict]:
+        """Get a user's token from the in-memory token store"""
+        return self.token_store.get(user_id)
+
+    async def _refresh_token(self, user_id: int, token_info: dict) -> dict:
+        """Exchange a refresh token; SpotifyOAuth saves the result to the token store"""
+        sp_oauth = self._create_oauth(user_id)
+        try:
+            token_info = await self._run_blocking(sp_oauth.refresh_access_token, token_info['refresh_token'])
+        except SpotifyOauthError as e:
+            if e.error == 'invalid_grant':
+                await self._require_reauth(user_id)
+            raise
+        self._schedule_token_refresh(user_id, token_info)
+        return token_info
+
+    def _schedule_token_refresh(self, user_id: int, token_info: dict):
+        """Queue a background refresh shortly before the token expires"""
+        self.token_refresher.start()
+        delay = token_info['expires_at'] - self.TOKEN_REFRESH_AHEAD - time.time()
+        self.token_refresher.schedule(user_id, max(delay, 0))
+
+    async def _refresh_due_token(self, user_id: int) -> Optional[float]:
+        """Refresh one user's token for the background refresher"""
+        async with self.token_locks[user_id]:
+            if self.config.MONITOR_WORKERS:
+                # A monitor worker may have refreshed it since it was loaded
+                token_info = await self._run_blocking(self.token_store.reload, user_id)
+            else:
+                token_info = await self._load_token(user_id)
+            if not token_info:
+                self.token_refresher.remove(user_id)
+                return None
+            if token_info['expires_at'] - time.time() > self.TOKEN_REFRESH_AHEAD:
+                # Already refreshed inline by get_client
+                return token_info['expires_at'] - self.TOKEN_REFRESH_AHEAD - time.time()
+            await self._refresh_token(user_id, token_info)
+        # _refresh_token has queued the next refresh
+        return None
+
+    async def _require_reauth(self, user_id: int):
+        """Drop a revoked token so the user is asked to authenticate again"""
+        logger.warning(f"Spotify access revoked for user {user_id}, re-authentication required")
+        self.token_refresher.remove(user_id)
+        self.clients.pop(user_id, None)
+        await self.stop_track_monitor(user_id)
+        await self._run_blocking(self.token_store.delete, user_id)
+
+    async def start(self):
+        """Load tokens and users from the database and resume background work"""
+        tokens = await self.token_store.load()
+        self.token_refresher.start()
+        now = time.time()
+        for user_id, token_info in tokens.items():
+            delay = token_info['expires_at'] - self.TOKEN_REFRESH_AHEAD - now
+            # Spread out tokens that are already due instead of refreshing them all at once
+            self.token_refresher.schedule(user_id, delay if delay > 0 else random.uniform(0, self.TOKEN_REFRESH_RETRY))
+        await self.history.load()
+        await self.restore_monitors()
+        await self.auth_listener.start()
+
     async def get_client(self, user_id: int, force_refresh: bool = False) -> spotipy.Spotify:
-        """Get a Spotify client for the given user"""
+        """Get the long-lived Spotify client for the given user"""
+        started = time.perf_counter()
         async with self.token_locks[user_id]:
+            GET_CLIENT_SECONDS.observe(time.perf_counter() - started, phase='lock_wait')
             try:
-                token_info = await self.check_auth_code(user_id)
-                
-                if not token_info:
-                    cache_path = self.cache_dir / f'cache-{user_id}'
-                    if cache_path.exists():
-                        with open(cache_path) as f:
-                            token_info = json.load(f)
+                with GET_CLIENT_SECONDS.time(phase='load'):
+                    token_info = await self._load_token(user_id)
                     
                 if not token_info or force_refresh:
-                    auth_url = self._create_oauth(user_id).get_authorize_url()
+                    auth_url = self.get_authorize_url(user_id)
                     raise ValueError(f"Please authenticate using this URL: {auth_url}")
                 
-                if self._create_oauth(user_id).is_token_expired(token_info):
-                    sp_oauth = self._create_oauth(user_id)
-                    token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-                    with open(self.cache_dir / f'cache-{user_id}', 'w') as f:
-                        json.dump(token_info, f)
+                if self._token_needs_refresh(token_info):
+                    with GET_CLIENT_SECONDS.time(phase='refresh'):
+                        token_info = await self._refresh_token(user_id, token_info)
                 
-                return spotipy.Spotify(auth=token_info['access_token'])
+                client = self.clients.get(user_id)
+                if client is None:
+                    client = spotipy.Spotify(
+                        auth=token_info['access_token'],
+                        requests_session=self.http_session
+                    )
+                    self.clients[user_id] = client
+                else:
+                    client.set_auth(token_info['access_token'])
+                return client
                 
             except Exception as e:
                 logger.error(f"Error in get_client: {e}")
                 raise
 
-    async def _monitor_track_changes(self, user_id: int):
-        """Monitor a user's currently playing track and send updates"""
+    async def _run_blocking(self, func, *args, **kwargs):
+        """Run a blocking function on the Spotify worker pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def call(self, user_id: int, method: str, *args, background: bool = False, **kwargs):
+        """Call a spotipy client method for the user without blocking the event loop
+
+        Every call waits its turn with the rate governor. Background calls
+        queue behind interactive ones and are not retried, since the caller
+        polls again later anyway.
+        """
+        sp = await self.get_client(user_id)
+        priority = RateGovernor.BACKGROUND if background else RateGovernor.INTERACTIVE
+        attempt = 0
         while True:
+            with SPOTIFY_RATE_WAIT_SECONDS.time(priority='background' if background else 'interactive'):
+                await self.governor.acquire(user_id, priority)
             try:
-                sp = await self.get_client(user_id)
-                current_track = sp.current_user_playing_track()
-                
-                if current_track and current_track.get('item'):
-                    track_id = current_track['item']['id']
-                    
-                    if self.last_tracks.get(user_id) != track_id:
-                        self.last_tracks[user_id] = track_id
-                        await self._send_track_update(user_id, current_track)
-                        
-            except Exception as e:
-                logger.error(f"Error in track monitor for user {user_id}: {e}")
+                with SPOTIFY_REQUEST_SECONDS.time(method=method):
+                    return await self._run_blocking(getattr(sp, method), *args, **kwargs)
+            except SpotifyException as e:
+                SPOTIFY_ERRORS.inc(method=method, status=e.http_status)
+                if e.http_status == 429:
+                    retry_after = self._retry_after(e)
+                    self.governor.pause(retry_after)
+                    delay = 0
+                elif 500 <= e.http_status < 600:
+                    retry_after = 0
+                    delay = random.uniform(0.5, 1.5) * (2 ** attempt)
+                else:
+                    raise
+                attempt += 1
+                if background or attempt > self.MAX_RETRIES or retry_after > self.MAX_RETRY_AFTER:
+                    raise RetryableSpotifyError(f"Spotify {method} failed after {attempt} attempt(s): {e}") from e
+                if delay:
+                    await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_after(error: SpotifyException) -> float:
+        """Read the Retry-After header of a 429 response, in seconds"""
+        try:
+            return max(1.0, float(error.headers.get('Retry-After', 1)))
+        except (TypeError, ValueError):
+            return 1.0
+
+    async def get_playback(self, user_id: int, background: bool = False) -> Optional[PlaybackSnapshot]:
+        """Get a user's playback state, shared between callers for a few seconds
+
+        An interactive caller does not join a background fetch in flight,
+        which would leave it queued behind all interactive traffic and
+        without retries; it fetches at its own priority and caches that.
+        """
+        if not background and user_id in self.background_fetches:
+            playback = await self._fetch_playback(user_id, background)
+            self.playback_cache.put(user_id, playback)
+            return playback
+        return await self.playback_cache.get(
+            user_id,
+            lambda: self._fetch_playback(user_id, background)
+        )
+
+    async def _fetch_playback(self, user_id: int, background: bool) -> Optional[PlaybackSnapshot]:
+        """Fetch playback state and keep only the fields the bot uses"""
+        if background:
+            self.background_fetches.add(user_id)
+        try:
+            playback = await self.call(user_id, 'current_playback', background=background)
+        finally:
+            if background:
+                self.background_fetches.discard(user_id)
+        return PlaybackSnapshot.from_api(playback, self.tracks)
+
+    async def _top_items(self, user_id: int, endpoint: str, parse, time_range: str, limit: int) -> list:
+        """Fetch a top items list through the per-user result cache"""
+        async def fetch():
+            response = await self.call(user_id, endpoint, limit=limit, time_range=time_range)
+            return [parse(item) for item in response['items']]
+        
+        ttl = self.TOP_ITEMS_TTL[time_range]
+        return await self.results.get((user_id, endpoint, time_range, limit), fetch, ttl=ttl, stale=ttl)
+
+    async def get_top_tracks(self, user_id: int, time_range: str = 'short_term', limit: int = 5) -> List[TrackSnapshot]:
+        """Get a user's top tracks, cached for as long as the time range allows"""
+        return await self._top_items(user_id, 'current_user_top_tracks', self.tracks.get, time_range, limit)
+
+    async def get_top_artists(self, user_id: int, time_range: str = 'short_term', limit: int = 5) -> List[ArtistSnapshot]:
+        """Get a user's top artists, cached for as long as the time range allows"""
+        return await self._top_items(user_id, 'current_user_top_artists', ArtistSnapshot.from_api, time_range, limit)
+
+    async def control(self, user_id: int, method: str, *args, **kwargs):
+        """Call a playback control method and drop the user's cached playback state"""
+        try:
+            return await self.call(user_id, method, *args, **kwargs)
+        finally:
+            self.playback_cache.invalidate(user_id)
+
+    async def close(self):
+        """Stop monitors and release the worker pool and HTTP session"""
+        await self.monitor.stop()
+        await self.live_displays.close()
+        await self.outbox.close()
+        self.results.close()
+        self.recommender.close()
+        await self.governor.close()
+        await self.user_store.close()
+        await self.history.close()
+        await self.auth_listener.close()
+        for task in self.auth_tasks | self.notify_tasks:
+            task.cancel()
+        await self.token_refresher.stop()
+        self.token_store.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.http_session.close()
+
+    async def _poll_track_changes(self, user_id: int) -> Optional[float]:
+        """Check a user's currently playing track once and send an update if it changed"""
+        playback = await self.get_playback(user_id, background=True)
+        self.history.observe(user_id, playback)
+        
+        if playback and playback.track:
+            track_id = playback.track.id
             
-            await asyncio.sleep(10)
+            if self.last_tracks.get(user_id) != track_id:
+                self._track_changed(user_id, playback)
+        return self._next_poll_delay(user_id, playback)
 
-    async def _send_track_update(self, user_id: int, current_track: dict):
+    def _track_changed(self, user_id: int, playback: PlaybackSnapshot):
+        """Remember a user's new track and announce it without waiting on Discord"""
+        self.last_tracks[user_id] = playback.track.id
+        self.user_store.update(user_id, last_track_id=playback.track.id)
+        task = asyncio.create_task(self._send_track_update(user_id, playback))
+        self.notify_tasks.add(task)
+        task.add_done_callback(self.notify_tasks.discard)
+
+    def _receive_track_change(self, user_id: int, playback: PlaybackSnapshot):
+        """Handle a track change reported by a monitor worker"""
+        # The worker has written the finished play to the shared history
+        self.history.count_play(user_id)
+        self._track_changed(user_id, playback)
+
+    def _next_poll_delay(self, user_id: int, playback: Optional[PlaybackSnapshot]) -> float:
+        """Work out when to poll a user next from their playback state
+
+        While a track plays the next poll lands just after it is predicted to
+        end, capped so skips made outside the bot are still noticed. When
+        nothing is playing (or Spotify answers 204) the interval doubles on
+        each poll up to the idle maximum.
+        """
+        config = self.config
+        remaining = playback.remaining if playback and playback.is_playing else None
+        if remaining is not None:
+            self.idle_polls.pop(user_id, None)
+            return min(remaining + self.TRACK_END_MARGIN, config.MONITOR_MAX_INTERVAL)
+        
+        idle = self.idle_polls[user_id]
+        # Bounded exponent: 2 ** idle stops fitting in a float after 1023 doublings
+        delay = min(config.MONITOR_POLL_INTERVAL * 2.0 ** min(idle, 64), config.MONITOR_IDLE_MAX_INTERVAL)
+        # Stop counting once the cap is reached
+        if delay < config.MONITOR_IDLE_MAX_INTERVAL:
+            self.idle_polls[user_id] = idle + 1
+        return delay
+
+    def poll_soon(self, user_id: int, delay: Optional[float] = None):
+        """Bring a monitored user's next poll forward, e.g. after a skip"""
+        if user_id in self.monitor:
+            self.idle_polls.pop(user_id, None)
+            self.monitor.schedule(user_id, self.SKIP_POLL_DELAY if delay is None else delay)
+
+    async def _send_track_update(self, user_id: int, playback: PlaybackSnapshot):
         """Send track update message to user"""
         try:
-            user = await self.bot.fetch_user(user_id)
-            dm_channel = await user.create_dm()
-            
-            track = current_track['item']
-            embed = discord.Embed(
-                title="Now Playing",
-                color=discord.Color.green(),
-                timestamp=datetime.now(timezone.utc)
+            embed, digest = self.renderer.render(playback)
+            view = PlaybackControls(self, user_id)
+            # Only the newest track is worth announcing if sends are backed up
+            message = await self.dm_channels.send(
+                user_id, background=True, supersede=('track', user_id), embed=embed, view=view
             )
-            
-            embed.add_field(name="Track", value=f"**{track['name']}**", inline=False)
-            embed.add_field(name="Artist", value=track['artists'][0]['name'], inline=True)
-            embed.add_field(name="Album", value=track['album']['name'], inline=True)
-            
-            if current_track['progress_ms'] is not None:
-                progress = current_track['progress_ms']
-                duration = track['duration_ms']
-                bar, current_time, total_time = create_progress_bar(progress, duration)
-                embed.add_field(
-                    name="Progress",
-                    value=f"`{bar}` {current_time}/{total_time}",
-                    inline=False
-                )
-            
-            if track['album']['images']:
-                embed.set_thumbnail(url=track['album']['images'][0]['url'])
-            
-            message = await dm_channel.send(embed=embed)
-            view = PlaybackControls(self, user_id, message)
-            await message.edit(view=view)
-            asyncio.create_task(view.start_periodic_updates())
+            if message is None:
+                view.stop()
+                return
+            view.message = message
+            view.last_digest = digest
+            await self.live_displays.register(view)
             
         except Exception as e:
             logger.error(f"Error sending track update for user {user_id}: {e}")
 
+    async def restore_monitors(self):
+        """Load saved users and resume their monitors, staggered over time
+
+        First polls are spread over long enough that the restored users fit
+        in the rate budget, so a restart does not burst against Spotify.
+        """
+        users = await self.user_store.load()
+        enabled = []
+        for user_id, record in users.items():
+            if record['last_track_id']:
+                self.last_tracks[user_id] = record['last_track_id']
+            if record['monitor_enabled'] and await self._load_token(user_id):
+                enabled.append(user_id)
+        
+        if not enabled:
+            return
+        window = max(self.config.MONITOR_POLL_INTERVAL, 2 * len(enabled) / self.config.SPOTIFY_RATE_LIMIT)
+        self.monitor.start()
+        for user_id in enabled:
+            self.monitor.schedule(user_id, random.uniform(0, window))
+        logger.info(f"Restored {len(enabled)} track monitors over {window:.0f}s")
+
+    def is_monitoring(self, user_id: int) -> bool:
+        """Check whether track changes are being monitored for a user"""
+        return user_id in self.monitor
+
     async def start_track_monitor(self, user_id: int):
         """Start monitoring track changes for a user"""
-        if user_id in self.track_monitor_tasks:
-            self.track_monitor_tasks[user_id].cancel()
-        
-        self.track_monitor_tasks[user_id] = asyncio.create_task(
-            self._monitor_track_changes(user_id)
-        )
+        self.monitor.start()
+        self.monitor.schedule(user_id)
+        self.user_store.update(user_id, monitor_enabled=True)
         logger.info(f"Started track monitor for user {user_id}")
 
     async def stop_track_monitor(self, user_id: int):
         """Stop monitoring track changes for a user"""
-        if user_id in self.track_monitor_tasks:
-            self.track_monitor_tasks[user_id].cancel()
-            del self.track_monitor_tasks[user_id]
+        if user_id in self.monitor:
+            self.monitor.remove(user_id)
+            self.idle_polls.pop(user_id, None)
+            self.user_store.update(user_id, monitor_enabled=False)
+            self.history.finish(user_id)
             logger.info(f"Stopped track monitor for user {user_id}")
 
 class SetupView(discord.ui.View):
@@ -429,8 +992,7 @@ class SetupView(discord.ui.View):
     async def setup_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         logger.info(f"Setup button clicked by user {interaction.user.id}")
         try:
-            sp_oauth = self.spotify_manager._create_oauth(interaction.user.id)
-            auth_url = sp_oauth.get_authorize_url()
+            auth_url = self.spotify_manager.get_authorize_url(interaction.user.id)
             
             embed = discord.Embed(
                 title="Connect Your Spotify Account",
@@ -474,24 +1036,135 @@ class SetupView(discord.ui.View):
                 ephemeral=True
             )
 
-class SpotifyBot(discord.Client):
+class StatsPaginator(discord.ui.View):
+    """Previous/Next buttons for a multi-page /stats response"""
+    def __init__(self, spotify_manager: 'SpotifyManager', user_id: int, pages: List[discord.Embed]):
+        super().__init__(timeout=300)
+        self.spotify_manager = spotify_manager
+        self.user_id = user_id
+        self.pages = pages
+        self.index = 0
+        self.message: Optional[discord.Message] = None
+        for i, page in enumerate(pages, 1):
+            page.set_footer(text=f"Page {i}/{len(pages)}")
+        self._update_buttons()
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.index == 0
+        self.next_page.disabled = self.index == len(self.pages) - 1
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.user_id
+
+    async def _show(self, interaction: discord.Interaction, index: int):
+        self.index = index
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.pages[index], view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, max(self.index - 1, 0))
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, min(self.index + 1, len(self.pages) - 1))
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.spotify_manager.outbox.edit(self.message, view=None, background=True)
+            except discord.HTTPException:
+                pass
+
+class SpotifyBot(discord.AutoShardedClient):
     """Main Discord bot class"""
     def __init__(self):
         intents = discord.Intents.default()
         intents.message_content = True
         intents.guilds = True
-        super().__init__(intents=intents)
-        self.tree = discord.app_commands.CommandTree(self)
         self.config = Config()
+        super().__init__(intents=intents, shard_count=self.config.SHARD_COUNT or None)
+        self.tree = discord.app_commands.CommandTree(self)
         self.spotify_manager = SpotifyManager(self.config, self)
+        self.metrics_server: Optional[MetricsServer] = None
+        # Shards that may IDENTIFY at the same time, from Discord's session start limits
+        self.identify_concurrency = 1
+        self.identify_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.last_identify: Dict[int, float] = {}
+        self.setup_message_sent = False
 
     async def setup_hook(self):
         """Initialize bot hooks and commands"""
         logger.info("Setting up bot hooks...")
         self.add_view(SetupView(self.spotify_manager))
+        try:
+            limits = await self.fetch_session_start_limits()
+            self.identify_concurrency = max(1, limits.max_concurrency)
+            logger.info(
+                f"Session starts remaining: {limits.remaining}/{limits.total}, "
+                f"identify concurrency {self.identify_concurrency}"
+            )
+        except Exception as e:
+            logger.warning(f"Could not fetch session start limits, identifying one shard at a time: {e}")
+        await self.spotify_manager.start()
+        if self.config.METRICS_PORT:
+            try:
+                self.metrics_server = MetricsServer(self.config.METRICS_PORT)
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"Could not start metrics server: {e}")
+                self.metrics_server = None
         await self.register_commands()
         logger.info("Bot hooks setup completed")
 
+    async def close(self):
+        """Shut down Spotify resources before closing the Discord connection"""
+        if self.metrics_server:
+            await self.metrics_server.close()
+        await self.spotify_manager.close()
+        await super().close()
+
+    async def before_identify_hook(self, shard_id: Optional[int], *, initial: bool = False):
+        """Pace IDENTIFYs so shards start and reconnect without a storm
+
+        Discord allows one IDENTIFY per interval in each concurrency
+        bucket. Shards in the same bucket queue here in turn, and a shard
+        only waits for whatever is left of the interval since the last one.
+        """
+        bucket = (shard_id or 0) % self.identify_concurrency
+        async with self.identify_locks[bucket]:
+            last = self.last_identify.get(bucket)
+            if last is not None:
+                wait = last + self.config.SHARD_IDENTIFY_INTERVAL - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.last_identify[bucket] = time.monotonic()
+
+    def _shard_latency(self, shard_id: int) -> float:
+        shard = self.get_shard(shard_id)
+        return shard.latency if shard else float('nan')
+
+    async def on_shard_connect(self, shard_id: int):
+        SHARD_EVENTS.inc(shard=shard_id, event='connect')
+        SHARD_LATENCY_SECONDS.set_function(functools.partial(self._shard_latency, shard_id), shard=shard_id)
+
+    async def on_shard_ready(self, shard_id: int):
+        SHARD_EVENTS.inc(shard=shard_id, event='ready')
+        logger.info(f"Shard {shard_id} ready")
+
+    async def on_shard_disconnect(self, shard_id: int):
+        SHARD_EVENTS.inc(shard=shard_id, event='disconnect')
+        logger.warning(f"Shard {shard_id} disconnected")
+
+    async def on_shard_resumed(self, shard_id: int):
+        SHARD_EVENTS.inc(shard=shard_id, event='resume')
+        logger.info(f"Shard {shard_id} resumed")
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command):
+        """Record how long a slash command took from the user's point of view"""
+        elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+        COMMAND_SECONDS.observe(elapsed, command=command.name)
+
     async def register_commands(self):
         """Register all slash commands"""
         @self.tree.command(
@@ -504,15 +1177,15 @@ class SpotifyBot(discord.Client):
             
             try:
                 user_id = interaction.user.id
-                if user_id in self.spotify_manager.track_monitor_tasks:
+                if self.spotify_manager.is_monitoring(user_id):
                     await self.spotify_manager.stop_track_monitor(user_id)
-                    await interaction.followup.send("?? Track notifications disabled", ephemeral=True)
+                    await self.spotify_manager.outbox.followup(interaction, "?? Track notifications disabled", ephemeral=True)
                 else:
                     await self.spotify_manager.start_track_monitor(user_id)
-                    await interaction.followup.send("?? Track notifications enabled", ephemeral=True)
+                    await self.spotify_manager.outbox.followup(interaction, "?? Track notifications enabled", ephemeral=True)
             except Exception as e:
                 logger.error(f"Error in toggle_monitor command: {e}")
-                await interaction.followup.send("? An error occurred. Please try again later.", ephemeral=True)
+                await self.spotify_manager.outbox.followup(interaction, "? An error occurred. Please try again later.", ephemeral=True)
 
         @self.tree.command(
             name="nowplaying",
@@ -523,67 +1196,28 @@ class SpotifyBot(discord.Client):
             await interaction.response.defer(ephemeral=True)
             
             try:
-                sp = await self.spotify_manager.get_client(interaction.user.id)
-                current_track = sp.current_user_playing_track()
+                playback = await self.spotify_manager.get_playback(interaction.user.id)
                 
-                if not current_track or not current_track.get('item'):
-                    await interaction.followup.send("No track currently playing!", ephemeral=True)
+                if not playback or not playback.track:
+                    await self.spotify_manager.outbox.followup(interaction, "No track currently playing!", ephemeral=True)
                     return
                 
-                track = current_track['item']
-                embed = discord.Embed(
-                    title="Now Playing",
-                    color=discord.Color.green(),
-                    timestamp=datetime.now(timezone.utc)
-                )
-                
-                embed.add_field(
-                    name="Track",
-                    value=f"**{track['name']}**",
-                    inline=False
-                )
-                embed.add_field(
-                    name="Artist",
-                    value=track['artists'][0]['name'],
-                    inline=True
-                )
-                embed.add_field(
-                    name="Album",
-                    value=track['album']['name'],
-                    inline=True
-                )
+                embed, digest = self.spotify_manager.renderer.render(playback)
+                view = PlaybackControls(self.spotify_manager, interaction.user.id)
+                view.message = await self.spotify_manager.outbox.followup(interaction, embed=embed, view=view, wait=True, ephemeral=True)
+                view.last_digest = digest
                 
-                if current_track['progress_ms'] is not None:
-                    progress = current_track['progress_ms']
-                    duration = track['duration_ms']
-                    bar, current_time, total_time = create_progress_bar(progress, duration)
-                    embed.add_field(
-                        name="Progress",
-                        value=f"`{bar}` {current_time}/{total_time}",
-                        inline=False
-                    )
-                
-                if track['album']['images']:
-                    embed.set_thumbnail(url=track['album']['images'][0]['url'])
-                
-                # Send initial message
-                message = await interaction.followup.send(embed=embed, wait=True, ephemeral=True)
-                
-                # Create view with message reference
-                view = PlaybackControls(self.spotify_manager, interaction.user.id, message)
-                await message.edit(view=view)
-                
-                # Start periodic updates
-                asyncio.create_task(view.start_periodic_updates())
+                # Keep this message updated, retiring any older display
+                await self.spotify_manager.live_displays.register(view)
                 
             except ValueError as e:
                 if "Please authenticate" in str(e):
-                    await interaction.followup.send(str(e), ephemeral=True)
+                    await self.spotify_manager.outbox.followup(interaction, str(e), ephemeral=True)
                 else:
                     raise
             except Exception as e:
                 logger.error(f"Error in nowplaying command: {e}")
-                await interaction.followup.send("? An error occurred. Please try again later.", ephemeral=True)
+                await self.spotify_manager.outbox.followup(interaction, "? An error occurred. Please try again later.", ephemeral=True)
 
         @self.tree.command(
             name="recommendations",
@@ -594,20 +1228,10 @@ class SpotifyBot(discord.Client):
             await interaction.response.defer(ephemeral=True)
             
             try:
-                sp = await self.spotify_manager.get_client(interaction.user.id)
-                
-                top_tracks = sp.current_user_top_tracks(limit=2, time_range='short_term')
-                seed_tracks = [track['id'] for track in top_tracks['items']]
-                
-                top_artists = sp.current_user_top_artists(limit=2, time_range='short_term')
-                seed_artists = [artist['id'] for artist in top_artists['items']]
-                
-                recommendations = sp.recommendations(
-                    seed_tracks=seed_tracks[:2],
-                    seed_artists=seed_artists[:2],
-                    seed_genres=[genre] if genre else [],
-                    limit=5
-                )
+                tracks = await self.spotify_manager.recommender.recommend(interaction.user.id, genre)
+                if not tracks:
+                    await self.spotify_manager.outbox.followup(interaction, "Not enough listening data for recommendations yet!", ephemeral=True)
+                    return
                 
                 embed = discord.Embed(
                     title="Recommended Tracks",
@@ -616,53 +1240,52 @@ class SpotifyBot(discord.Client):
                     timestamp=datetime.now(timezone.utc)
                 )
                 
-                for i, track in enumerate(recommendations['tracks'], 1):
+                for i, track in enumerate(tracks, 1):
                     embed.add_field(
-                        name=f"{i}. {track['name']}",
-                        value=f"By {track['artists'][0]['name']}",
+                        name=f"{i}. {track.name}",
+                        value=f"By {track.artist}",
                         inline=False
                     )
                 
-                await interaction.followup.send(embed=embed, ephemeral=True)
+                await self.spotify_manager.outbox.followup(interaction, embed=embed, ephemeral=True)
                 
             except ValueError as e:
                 if "Please authenticate" in str(e):
-                    await interaction.followup.send(str(e), ephemeral=True)
+                    await self.spotify_manager.outbox.followup(interaction, str(e), ephemeral=True)
                 else:
                     raise
             except Exception as e:
                 logger.error(f"Error in recommendations command: {e}")
-                await interaction.followup.send("? An error occurred. Please try again later.", ephemeral=True)
+                await self.spotify_manager.outbox.followup(interaction, "? An error occurred. Please try again later.", ephemeral=True)
 
         @self.tree.command(
             name="playlist",
             description="Create a playlist based on your top tracks"
         )
-        async def playlist(interaction: discord.Interaction, name: str, track_count: int = 20):
+        @discord.app_commands.describe(track_count=f"Number of tracks, up to {PlaylistBuilder.MAX_TRACKS}")
+        async def playlist(
+            interaction: discord.Interaction,
+            name: str,
+            track_count: discord.app_commands.Range[int, 1, PlaylistBuilder.MAX_TRACKS] = 20
+        ):
             logger.info(f"Playlist command used by {interaction.user.id}")
             await interaction.response.defer(ephemeral=True)
             
             try:
-                sp = await self.spotify_manager.get_client(interaction.user.id)
-                
-                top_tracks = sp.current_user_top_tracks(
-                    limit=track_count,
-                    time_range='short_term'
-                )
+                async def report(stage: str, done: int, total: int):
+                    # A newer progress update replaces one still waiting in the outbox
+                    await self.spotify_manager.outbox.edit_response(interaction, content=f"{stage}... {done}/{total}")
                 
-                user_id = sp.me()['id']
-                playlist = sp.user_playlist_create(
-                    user_id,
+                builder = PlaylistBuilder(self.spotify_manager, interaction.user.id, progress=report)
+                playlist, total = await builder.build(
                     name,
+                    track_count,
                     description=f"Created by Spotify Bot on {datetime.now().strftime('%Y-%m-%d')}"
                 )
                 
-                track_uris = [track['uri'] for track in top_tracks['items']]
-                sp.playlist_add_items(playlist['id'], track_uris)
-                
                 embed = discord.Embed(
                     title="Playlist Created!",
-                    description=f"Created playlist '{name}' with your top {len(track_uris)} tracks",
+                    description=f"Created playlist '{name}' with {total} tracks",
                     color=discord.Color.green(),
                     timestamp=datetime.now(timezone.utc)
                 )
@@ -672,69 +1295,77 @@ class SpotifyBot(discord.Client):
                     inline=False
                 )
                 
-                await interaction.followup.send(embed=embed, ephemeral=True)
+                await self.spotify_manager.outbox.edit_response(interaction, content=None, embed=embed)
                 
             except ValueError as e:
                 if "Please authenticate" in str(e):
-                    await interaction.followup.send(str(e), ephemeral=True)
+                    await self.spotify_manager.outbox.followup(interaction, str(e), ephemeral=True)
                 else:
                     raise
             except Exception as e:
                 logger.error(f"Error in playlist command: {e}")
-                await interaction.followup.send("? An error occurred. Please try again later.", ephemeral=True)
+                await self.spotify_manager.outbox.followup(interaction, "? An error occurred. Please try again later.", ephemeral=True)
 
         @self.tree.command(
             name="stats",
             description="Show your listening statistics"
         )
-        async def stats(interaction: discord.Interaction):
+        @discord.app_commands.describe(time_range="Period to show, or all of them")
+        @discord.app_commands.choices(time_range=[
+            discord.app_commands.Choice(name=time_range.label, value=time_range.value)
+            for time_range in TimeRange
+        ] + [
+            discord.app_commands.Choice(name="Last 24 Hours", value='last_24h'),
+            discord.app_commands.Choice(name="All", value='all'),
+        ])
+        async def stats(interaction: discord.Interaction, time_range: str = TimeRange.SHORT_TERM.value):
             logger.info(f"Stats command used by {interaction.user.id}")
             await interaction.response.defer(ephemeral=True)
             
             try:
-                sp = await self.spotify_manager.get_client(interaction.user.id)
-                
-                top_tracks = sp.current_user_top_tracks(limit=5, time_range='short_term')
-                top_artists = sp.current_user_top_artists(limit=5, time_range='short_term')
+                spotify = self.spotify_manager
+                user_id = interaction.user.id
                 
-                embed = discord.Embed(
-                    title="Your Spotify Statistics",
-                    color=discord.Color.green(),
-                    timestamp=datetime.now(timezone.utc)
-                )
+                if time_range == 'last_24h':
+                    # Spotify has no daily range; answer from the monitor's history
+                    since = time.time() - 24 * 60 * 60
+                    top_tracks, top_artists = await asyncio.gather(
+                        spotify.history.top_tracks(user_id, since),
+                        spotify.history.top_artists(user_id, since)
+                    )
+                    embed = render_stats_page("Last 24 Hours", top_tracks, top_artists)
+                    if not top_tracks:
+                        embed.set_footer(text="Turn on /toggle_monitor to record what you play")
+                    await self.spotify_manager.outbox.followup(interaction, embed=embed, ephemeral=True)
+                    return
                 
-                # Add top tracks
-                tracks_text = ""
-                for i, track in enumerate(top_tracks['items'], 1):
-                    tracks_text = ""
-                for i, track in enumerate(top_tracks['items'], 1):
-                    tracks_text += f"{i}. {track['name']} by {track['artists'][0]['name']}\n"
-                embed.add_field(
-                    name="Your Top Tracks (Last 4 Weeks)",
-                    value=tracks_text or "No tracks found",
-                    inline=False
-                )
+                ranges = list(TimeRange) if time_range == 'all' else [TimeRange(time_range)]
                 
-                # Add top artists
-                artists_text = ""
-                for i, artist in enumerate(top_artists['items'], 1):
-                    artists_text += f"{i}. {artist['name']}\n"
-                embed.add_field(
-                    name="Your Top Artists (Last 4 Weeks)",
-                    value=artists_text or "No artists found",
-                    inline=False
-                )
+                # Every list is fetched at once, so "all" costs about one request's latency
+                results = await asyncio.gather(*(
+                    fetch(user_id, time_range=period.value, limit=10)
+                    for period in ranges
+                    for fetch in (spotify.get_top_tracks, spotify.get_top_artists)
+                ))
+                pages = [
+                    render_stats_page(period.label, results[2 * i], results[2 * i + 1])
+                    for i, period in enumerate(ranges)
+                ]
                 
-                await interaction.followup.send(embed=embed, ephemeral=True)
+                if len(pages) == 1:
+                    await self.spotify_manager.outbox.followup(interaction, embed=pages[0], ephemeral=True)
+                else:
+                    view = StatsPaginator(self.spotify_manager, user_id, pages)
+                    view.message = await self.spotify_manager.outbox.followup(interaction, embed=pages[0], view=view, wait=True, ephemeral=True)
                 
             except ValueError as e:
                 if "Please authenticate" in str(e):
-                    await interaction.followup.send(str(e), ephemeral=True)
+                    await self.spotify_manager.outbox.followup(interaction, str(e), ephemeral=True)
                 else:
                     raise
             except Exception as e:
                 logger.error(f"Error in stats command: {e}")
-                await interaction.followup.send("? An error occurred. Please try again later.", ephemeral=True)
+                await self.spotify_manager.outbox.followup(interaction, "? An error occurred. Please try again later.", ephemeral=True)
 
         try:
             logger.info("Syncing application commands globally...")
@@ -755,7 +1386,9 @@ class SpotifyBot(discord.Client):
             logger.info("Deleting old setup messages...")
             async for message in channel.history(limit=100):
                 if message.author == self.user:
-                    await message.delete()
+                    await self.spotify_manager.outbox.request(
+                        ('channel', channel.id), message.delete, action='delete', background=True
+                    )
             
             embed = discord.Embed(
                 title="Spotify Bot Setup",
@@ -793,7 +1426,7 @@ class SpotifyBot(discord.Client):
             embed.set_footer(text="Your Spotify session will be automatically refreshed when needed")
             
             view = SetupView(self.spotify_manager)
-            await channel.send(embed=embed, view=view)
+            await self.spotify_manager.outbox.request(('channel', channel.id), channel.send, embed=embed, view=view)
             logger.info("Setup message created successfully")
             return True
             
@@ -803,8 +1436,10 @@ class SpotifyBot(discord.Client):
 
     async def on_ready(self):
         """Called when the bot is ready and connected to Discord"""
-        logger.info(f'Logged in as {self.user.name} ({self.user.id})')
-        await self.create_setup_message(self.config.CHANNEL_ID)
+        logger.info(f'Logged in as {self.user.name} ({self.user.id}) on {self.shard_count} shards')
+        # on_ready fires again after shards re-identify; post the setup message once
+        if not self.setup_message_sent:
+            self.setup_message_sent = bool(await self.create_setup_message(self.config.CHANNEL_ID))
 
     async def on_guild_join(self, guild: discord.Guild):
         """Called when the bot joins a new server"""
@@ -853,7 +1488,7 @@ class SpotifyBot(discord.Client):
             welcome_embed.set_footer(text="Note: Users need to connect their own Spotify accounts to use the bot")
             
             try:
-                await channel.send(embed=welcome_embed)
+                await self.spotify_manager.outbox.request(('channel', channel.id), channel.send, embed=welcome_embed)
             except Exception as e:
                 logger.error(f"Error sending welcome message: {e}")
 
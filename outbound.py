@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from metrics import DISCORD_OUTBOX_DROPPED, DISCORD_REQUEST_SECONDS
+
+logger = logging.getLogger('SpotifyBot.Outbox')
+
+
+class _Bucket:
+    """Token bucket for one Discord rate limit"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Seconds until a token is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    @property
+    def idle(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ('route', 'action', 'priority', 'seq', 'key', 'request', 'kwargs', 'future')
+
+    def __init__(self, route: Hashable, action: str, priority: int, seq: int, key: Optional[Hashable],
+                 request: Callable[..., Awaitable], kwargs: dict, future: asyncio.Future):
+        self.route = route
+        self.action = action
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.request = request
+        self.kwargs = kwargs
+        self.future = future
+
+
+class _Route:
+    __slots__ = ('bucket', 'jobs', 'token')
+
+    def __init__(self, bucket: _Bucket):
+        self.bucket = bucket
+        self.jobs: List[_Job] = []
+        # Identifies the route's live entry in the ready or waiting heap
+        self.token: Optional[int] = None
+
+
+class DiscordOutbox:
+    """Single queue for the REST calls the bot makes to Discord
+
+    Every call names a route (a channel, or an interaction's webhook) and
+    goes out only when both the route's bucket and the app-wide bucket
+    have room, so bursts of track changes cannot push the bot into
+    Discord's global rate limit. Interactive calls are sent before
+    background ones.
+
+    Pending edits to the same message are merged so only the latest state
+    is sent, and a pending call submitted with a ``supersede`` key is
+    dropped when a newer call with the same key arrives; its caller gets
+    None instead of a message.
+    """
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    # Discord allows about five messages per five seconds in a channel
+    ROUTE_RATE = 1.0
+    ROUTE_BURST = 5
+    # Idle route buckets are forgotten once there are this many
+    MAX_ROUTES = 10000
+
+    def __init__(self, rate: float, burst: int):
+        self._global = _Bucket(rate, burst)
+        self._routes: Dict[Hashable, _Route] = {}
+        self._pending: Dict[Hashable, _Job] = {}
+        self._ready: List[Tuple[int, int, int, Hashable]] = []
+        self._waiting: List[Tuple[float, int, Hashable]] = []
+        self._counter = itertools.count()
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        # Metrics
+        self.sent = 0
+        self.merged = 0
+        self.superseded = 0
+
+    def __len__(self) -> int:
+        """Number of calls waiting to be sent"""
+        return sum(len(route.jobs) for route in self._routes.values())
+
+    async def request(self, route: Hashable, request: Callable[..., Awaitable], *, action: str = 'send',
+                      background: bool = False, supersede: Optional[Hashable] = None, **kwargs):
+        """Queue a call to Discord and wait for its result
+
+        Returns None if a newer call with the same supersede key replaced
+        this one before it was sent.
+        """
+        priority = self.BACKGROUND if background else self.INTERACTIVE
+        previous = self._pending.pop(supersede, None) if supersede is not None else None
+        if previous is not None:
+            self._drop(previous)
+        return await self._submit(route, action, priority, supersede, request, kwargs)
+
+    async def edit(self, message, *, background: bool = False, **kwargs):
+        """Edit a message, merged with any edit to it still waiting"""
+        key = ('edit', message.id)
+        priority = self.BACKGROUND if background else self.INTERACTIVE
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.kwargs.update(kwargs)
+            if priority < pending.priority:
+                pending.priority = priority
+                self._schedule(pending.route, requeue=True)
+            self.merged += 1
+            DISCORD_OUTBOX_DROPPED.inc(reason='merged')
+            return await asyncio.shield(pending.future)
+        return await self._submit(('channel', message.channel.id), 'edit', priority, key, message.edit, kwargs)
+
+    async def followup(self, interaction, *args, **kwargs):
+        """Send an interaction followup ahead of any background traffic"""
+        return await self.request(
+            ('interaction', interaction.id),
+            lambda **options: interaction.followup.send(*args, **options),
+            action='followup',
+            **kwargs
+        )
+
+    async def edit_response(self, interaction, **kwargs):
+        """Edit an interaction's original response, replacing any edit to it still waiting"""
+        return await self.request(
+            ('interaction', interaction.id),
+            interaction.edit_original_response,
+            action='edit',
+            supersede=('response', interaction.id),
+            **kwargs
+        )
+
+    async def _submit(self, route: Hashable, action: str, priority: int, key: Optional[Hashable],
+                      request: Callable[..., Awaitable], kwargs: dict):
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be left to read the error once every waiter is gone
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        job = _Job(route, action, priority, next(self._counter), key, request, kwargs, future)
+        if key is not None:
+            self._pending[key] = job
+        entry = self._routes.get(route)
+        if entry is None:
+            entry = self._routes[route] = _Route(_Bucket(self.ROUTE_RATE, self.ROUTE_BURST))
+        entry.jobs.append(job)
+        self._ensure_dispatcher()
+        self._schedule(route)
+        return await asyncio.shield(future)
+
+    def _drop(self, job: _Job):
+        entry = self._routes.get(job.route)
+        if entry is not None and job in entry.jobs:
+            entry.jobs.remove(job)
+        if not job.future.done():
+            job.future.set_result(None)
+        self.superseded += 1
+        DISCORD_OUTBOX_DROPPED.inc(reason='superseded')
+
+    def _schedule(self, route: Hashable, requeue: bool = False):
+        """Give a route with queued calls an entry in the ready or waiting heap"""
+        entry = self._routes[route]
+        if (entry.token is not None and not requeue) or not entry.jobs:
+            return
+        # Any older heap entry for the route is now stale and will be skipped
+        entry.token = token = next(self._counter)
+        delay = entry.bucket.delay()
+        if delay > 0:
+            heapq.heappush(self._waiting, (time.monotonic() + delay, token, route))
+        else:
+            head = min(entry.jobs, key=lambda job: (job.priority, job.seq))
+            heapq.heappush(self._ready, (head.priority, head.seq, token, route))
+        self._wakeup.set()
+
+    def _claim(self, route: Hashable, token: int) -> Optional[_Route]:
+        """Take a route off the heaps if this entry is still its live one"""
+        entry = self._routes.get(route)
+        if entry is None or entry.token != token:
+            return None
+        entry.token = None
+        return entry
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, token, route = heapq.heappop(self._waiting)
+                if self._claim(route, token):
+                    self._schedule(route)
+
+            if not self._ready:
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            wait = self._global.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, token, route = heapq.heappop(self._ready)
+            entry = self._claim(route, token)
+            if entry is None or not entry.jobs:
+                continue
+            if entry.bucket.delay() > 0:
+                # Held back by a 429 since it was marked ready
+                self._schedule(route)
+                continue
+            job = min(entry.jobs, key=lambda job: (job.priority, job.seq))
+            entry.jobs.remove(job)
+            if job.key is not None and self._pending.get(job.key) is job:
+                del self._pending[job.key]
+
+            self._global.take()
+            entry.bucket.take()
+            task = asyncio.create_task(self._send(job, entry.bucket))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self._schedule(route)
+            self._prune()
+
+    async def _send(self, job: _Job, bucket: _Bucket):
+        try:
+            with DISCORD_REQUEST_SECONDS.time(action=job.action):
+                result = await job.request(**job.kwargs)
+        except Exception as e:
+            if getattr(e, 'status', None) == 429:
+                # discord.py gave up waiting; hold the whole route back
+                retry_after = float(getattr(e, 'retry_after', 0) or 5)
+                bucket.blocked_until = time.monotonic() + retry_after
+                logger.warning(f"Discord rate limited route {job.route}, holding it for {retry_after:.1f}s")
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def _prune(self):
+        if len(self._routes) <= self.MAX_ROUTES:
+            return
+        self._routes = {
+            route: entry for route, entry in self._routes.items()
+            if entry.jobs or entry.token is not None or not entry.bucket.idle
+        }
+
+    async def close(self):
+        """Stop sending and fail anything still queued"""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for task in list(self._tasks):
+            task.cancel()
+        for entry in self._routes.values():
+            for job in entry.jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self._routes.clear()
+        self._pending.clear()
+        self._ready.clear()
+        self._waiting.clear()
+
+    def stats(self) -> dict:
+        """Snapshot of the outbox metrics"""
+        return {
+            'pending': len(self),
+            'routes': len(self._routes),
+            'sent': self.sent,
+            'merged': self.merged,
+            'superseded': self.superseded,
+        }
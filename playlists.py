@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from spotipy.exceptions import SpotifyException
+
+from errors import RetryableSpotifyError, SpotifyError
+
+logger = logging.getLogger('SpotifyBot.Playlists')
+
+ProgressCallback = Callable[[str, int, int], Awaitable[None]]
+
+
+class PlaylistBuilder:
+    """Collects tracks from several sources and writes them in chunks
+
+    Tracks come from every page of the user's top tracks in each time
+    range, then recent plays, then recommendations seeded from what was
+    collected, until the requested size is reached. URIs are
+    deduplicated in the order they are found. Writes go out one after
+    another in chunks of 100 (the Web API maximum).
+    """
+    MAX_TRACKS = 1000
+    PAGE_SIZE = 50
+    RECOMMENDATION_LIMIT = 100
+    CHUNK_SIZE = 100
+    WRITE_RETRIES = 3
+    # Shortest gap between progress reports
+    PROGRESS_INTERVAL = 1.5
+
+    def __init__(self, spotify_manager, user_id: int, progress: Optional[ProgressCallback] = None):
+        self.spotify = spotify_manager
+        self.user_id = user_id
+        self.progress = progress
+        self._last_progress = 0.0
+
+    async def _report(self, stage: str, done: int, total: int, force: bool = False):
+        if not self.progress:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_progress < self.PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        try:
+            await self.progress(stage, done, total)
+        except Exception as e:
+            logger.warning(f"Error reporting playlist progress: {e}")
+
+    async def _top_track_pages(self) -> AsyncIterator[List[dict]]:
+        for time_range in ('short_term', 'medium_term', 'long_term'):
+            offset = 0
+            while True:
+                page = await self.spotify.call(
+                    self.user_id,
+                    'current_user_top_tracks',
+                    limit=self.PAGE_SIZE,
+                    offset=offset,
+                    time_range=time_range
+                )
+                yield page['items']
+                if not page.get('next') or not page['items']:
+                    break
+                offset += len(page['items'])
+
+    async def _recent_tracks(self) -> AsyncIterator[List[dict]]:
+        # Spotify only keeps the last 50 plays
+        page = await self.spotify.call(self.user_id, 'current_user_recently_played', limit=self.PAGE_SIZE)
+        yield [play['track'] for play in page['items']]
+
+    async def _recommended_tracks(self, seeds: List[str]) -> AsyncIterator[List[dict]]:
+        # Five seeds per request is the Web API maximum
+        for start in range(0, len(seeds), 5):
+            response = await self.spotify.call(
+                self.user_id,
+                'recommendations',
+                seed_tracks=seeds[start:start + 5],
+                limit=self.RECOMMENDATION_LIMIT
+            )
+            yield response['tracks']
+
+    async def collect(self, count: int) -> List[str]:
+        """Gather up to count distinct track URIs"""
+        uris: Dict[str, None] = {}
+        seeds: List[str] = []
+
+        async def take(pages: AsyncIterator[List[dict]]) -> bool:
+            async for items in pages:
+                for track in items:
+                    if not track or not track.get('uri') or track.get('is_local'):
+                        continue
+                    if track['uri'] not in uris and track.get('id'):
+                        seeds.append(track['id'])
+                    uris.setdefault(track['uri'])
+                    if len(uris) >= count:
+                        return True
+                await self._report("Collecting tracks", len(uris), count)
+            return False
+
+        if await take(self._top_track_pages()) or await take(self._recent_tracks()):
+            return list(uris)
+        try:
+            await take(self._recommended_tracks(list(seeds)))
+        except (SpotifyException, SpotifyError) as e:
+            # Newer Spotify apps may not have access to recommendations
+            logger.warning(f"Recommendations unavailable for user {self.user_id}: {e}")
+        return list(uris)[:count]
+
+    async def _add_chunk(self, playlist_id: str, chunk: List[str]):
+        for attempt in range(self.WRITE_RETRIES + 1):
+            try:
+                await self.spotify.call(self.user_id, 'playlist_add_items', playlist_id, chunk)
+                return
+            except RetryableSpotifyError as e:
+                # call() has already retried briefly; back off for longer
+                if attempt == self.WRITE_RETRIES:
+                    raise
+                logger.warning(f"Retrying playlist write for user {self.user_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def write(self, playlist_id: str, uris: List[str]):
+        """Add tracks to a playlist in 100-item chunks
+
+        Each chunk is appended only after the previous one is written, so
+        the playlist keeps the order the tracks were collected in.
+        """
+        for start in range(0, len(uris), self.CHUNK_SIZE):
+            chunk = uris[start:start + self.CHUNK_SIZE]
+            await self._add_chunk(playlist_id, chunk)
+            await self._report("Adding tracks", start + len(chunk), len(uris))
+
+    async def build(self, name: str, count: int, description: str) -> Tuple[dict, int]:
+        """Create a playlist of up to count tracks; returns it and its size"""
+        uris = await self.collect(count)
+        await self._report("Creating playlist", len(uris), count, force=True)
+        spotify_user_id = (await self.spotify.call(self.user_id, 'me'))['id']
+        playlist = await self.spotify.call(
+            self.user_id,
+            'user_playlist_create',
+            spotify_user_id,
+            name,
+            description=description
+        )
+        await self.write(playlist['id'], uris)
+        return playlist, len(uris)
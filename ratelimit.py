@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('SpotifyBot.RateGovernor')
+
+
+class RateGovernor:
+    """App-wide token bucket for Spotify requests
+
+    Callers wait in a queue ordered by priority first and then by a
+    per-user virtual clock, so interactive commands jump ahead of
+    background polling and a single busy user cannot starve the rest.
+    A ``Retry-After`` from Spotify pauses every request until it passes.
+    """
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queue: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        # Fair queueing: every request a user makes moves their tag forward
+        self._virtual_time = 0
+        self._user_tags: Dict[int, int] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        # Metrics
+        self.granted = 0
+        self.throttled = 0
+        self.pauses = 0
+
+    @property
+    def waiting(self) -> int:
+        """Number of requests queued for a token"""
+        return len(self._queue)
+
+    @property
+    def paused_for(self) -> float:
+        """Seconds left on the current Retry-After pause"""
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def pause(self, seconds: float):
+        """Hold every request for the given number of seconds"""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self.pauses += 1
+            logger.warning(f"Spotify rate limited, pausing requests for {seconds:.1f}s")
+
+    async def acquire(self, user_id: int, priority: int = INTERACTIVE):
+        """Wait until this user's request may be sent"""
+        if (
+            not self._queue
+            and self.paused_for == 0
+            and self._take_token()
+        ):
+            self._advance_user(user_id)
+            self.granted += 1
+            return
+
+        self.throttled += 1
+        tag = self._advance_user(user_id)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, tag, next(self._counter), future))
+        self._ensure_dispatcher()
+        self._wakeup.set()
+        await future
+
+    def _advance_user(self, user_id: int) -> int:
+        tag = max(self._virtual_time, self._user_tags.get(user_id, 0)) + 1
+        self._user_tags[user_id] = tag
+        return tag
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take_token(self) -> bool:
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            # Drop waiters that gave up
+            while self._queue and self._queue[0][3].done():
+                heapq.heappop(self._queue)
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            paused = self.paused_for
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            if not self._take_token():
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+
+            _, tag, _, future = heapq.heappop(self._queue)
+            if future.done():
+                self._tokens += 1
+                continue
+            self._virtual_time = max(self._virtual_time, tag)
+            self.granted += 1
+            future.set_result(None)
+
+            if len(self._user_tags) > 10000:
+                self._user_tags = {
+                    user_id: user_tag for user_id, user_tag in self._user_tags.items()
+                    if user_tag > self._virtual_time
+                }
+
+    async def close(self):
+        """Stop the dispatcher and release anyone still waiting"""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for _, _, _, future in self._queue:
+            if not future.done():
+                future.cancel()
+        self._queue.clear()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from spotipy.exceptions import SpotifyException
+
+from cache import TTLCache
+from errors import SpotifyError
+from models import TrackSnapshot
+
+logger = logging.getLogger('SpotifyBot.Recommender')
+
+
+class FeatureCache:
+    """Audio features per track and genres per artist, shared by all users
+
+    Missing ids are fetched in the largest batches the Web API allows,
+    and ids Spotify has nothing for are remembered so they are not asked
+    for again. Fetch errors are logged and whatever is cached is returned,
+    so recommendations still work while Spotify is rate limiting us.
+    """
+    AUDIO_FEATURES = (
+        'danceability', 'energy', 'valence', 'acousticness',
+        'instrumentalness', 'speechiness', 'liveness',
+    )
+    FEATURE_BATCH = 100
+    ARTIST_BATCH = 50
+
+    def __init__(self, spotify_manager, max_size: int = 100000):
+        self.spotify = spotify_manager
+        self.max_size = max_size
+        self._vectors: 'OrderedDict[str, Optional[np.ndarray]]' = OrderedDict()
+        self._genres: 'OrderedDict[str, Tuple[str, ...]]' = OrderedDict()
+
+    @classmethod
+    def _vector(cls, features: Optional[dict]) -> Optional[np.ndarray]:
+        if not features:
+            return None
+        values = [features.get(name) or 0.0 for name in cls.AUDIO_FEATURES]
+        # Bring tempo and loudness onto the same 0-1 scale as the rest
+        values.append(min((features.get('tempo') or 0.0) / 250, 1.0))
+        values.append(min(max(((features.get('loudness') or -60.0) + 60) / 60, 0.0), 1.0))
+        return np.asarray(values, dtype=np.float32)
+
+    def _store(self, cache: OrderedDict, key: str, value):
+        cache[key] = value
+        if len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    async def _fetch_batches(self, user_id: int, ids: List[str], size: int, fetch) -> None:
+        batches = [ids[i:i + size] for i in range(0, len(ids), size)]
+        results = await asyncio.gather(*(fetch(user_id, batch) for batch in batches), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Error fetching features for user {user_id}: {result}")
+
+    async def _fetch_audio_features(self, user_id: int, batch: List[str]):
+        response = await self.spotify.call(user_id, 'audio_features', batch)
+        for track_id, features in zip(batch, response or []):
+            self._store(self._vectors, track_id, self._vector(features))
+
+    async def _fetch_artists(self, user_id: int, batch: List[str]):
+        response = await self.spotify.call(user_id, 'artists', batch)
+        for artist in response['artists']:
+            if artist:
+                self._store(self._genres, artist['id'], tuple(artist.get('genres') or ()))
+
+    async def track_vectors(self, user_id: int, track_ids: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Feature vectors for the given tracks that Spotify has data for"""
+        track_ids = list(dict.fromkeys(track_ids))
+        missing = [track_id for track_id in track_ids if track_id not in self._vectors]
+        if missing:
+            await self._fetch_batches(user_id, missing, self.FEATURE_BATCH, self._fetch_audio_features)
+        vectors = {}
+        for track_id in track_ids:
+            vector = self._vectors.get(track_id)
+            if vector is not None:
+                vectors[track_id] = vector
+        return vectors
+
+    async def artist_genres(self, user_id: int, artist_ids: Iterable[str]) -> Dict[str, Tuple[str, ...]]:
+        """Genres for the given artists"""
+        artist_ids = list(dict.fromkeys(artist_ids))
+        missing = [artist_id for artist_id in artist_ids if artist_id not in self._genres]
+        if missing:
+            await self._fetch_batches(user_id, missing, self.ARTIST_BATCH, self._fetch_artists)
+        return {artist_id: self._genres[artist_id] for artist_id in artist_ids if artist_id in self._genres}
+
+
+class Recommender:
+    """Ranks candidate tracks against a user's recent listening
+
+    The user's profile is their recent plays from the monitor's history,
+    or their top tracks when there is no history yet. Candidates are a
+    cached pool from Spotify's recommendations, expanded with tracks from
+    the user's own history they have not played lately. Candidates are
+    scored with NumPy by audio-feature similarity to the profile and by
+    genre overlap, without further Spotify calls once features are cached.
+
+    Results are cached per user and genre, and a new play in the user's
+    history invalidates them.
+    """
+    PROFILE_SIZE = 50
+    CANDIDATE_LIMIT = 100
+    # Candidate pools are fresh for six hours and served stale for a day
+    CANDIDATE_TTL = 6 * 60 * 60
+    CANDIDATE_STALE = 24 * 60 * 60
+    RESULT_TTL = 60 * 60
+    GENRE_WEIGHT = 0.5
+    # Small bonus for Spotify's own ordering, used to break ties
+    RANK_WEIGHT = 0.1
+
+    def __init__(self, spotify_manager):
+        self.spotify = spotify_manager
+        self.features = FeatureCache(spotify_manager)
+        self.candidates = TTLCache(ttl=self.CANDIDATE_TTL)
+        self.results = TTLCache(ttl=self.RESULT_TTL)
+
+    async def _profile(self, user_id: int) -> List[TrackSnapshot]:
+        profile = await self.spotify.history.recent_tracks(user_id, self.PROFILE_SIZE)
+        if not profile:
+            profile = await self.spotify.get_top_tracks(user_id, limit=self.PROFILE_SIZE)
+        return profile
+
+    async def _spotify_candidates(self, user_id: int, profile: List[TrackSnapshot], genre: Optional[str]) -> List[TrackSnapshot]:
+        async def fetch():
+            seed_genres = [genre] if genre else []
+            # Five seeds in total is the Web API maximum
+            seed_tracks = [track.id for track in profile if track.id][:5 - len(seed_genres)]
+            response = await self.spotify.call(
+                user_id,
+                'recommendations',
+                seed_tracks=seed_tracks,
+                seed_genres=seed_genres,
+                limit=self.CANDIDATE_LIMIT
+            )
+            return [self.spotify.tracks.get(item) for item in response['tracks']]
+
+        try:
+            return await self.candidates.get(
+                (user_id, genre), fetch, ttl=self.CANDIDATE_TTL, stale=self.CANDIDATE_STALE
+            )
+        except (SpotifyException, SpotifyError) as e:
+            logger.warning(f"Recommendation candidates unavailable for user {user_id}: {e}")
+            return []
+
+    async def _candidates(self, user_id: int, profile: List[TrackSnapshot], genre: Optional[str]) -> List[TrackSnapshot]:
+        candidates = await self._spotify_candidates(user_id, profile, genre)
+        if not genre:
+            # Favourites from history the user has not played lately
+            candidates = candidates + await self.spotify.history.top_tracks(user_id, 0, limit=self.PROFILE_SIZE)
+        recent = {track.id for track in profile}
+        unique = {}
+        for track in candidates:
+            if track.id and track.id not in recent:
+                unique.setdefault(track.id, track)
+        return list(unique.values())
+
+    def _score(self, profile: List[TrackSnapshot], candidates: List[TrackSnapshot],
+               vectors: Dict[str, np.ndarray], genres: Dict[str, Tuple[str, ...]]) -> np.ndarray:
+        count = len(candidates)
+        scores = self.RANK_WEIGHT * (1 - np.arange(count, dtype=np.float32) / count)
+
+        profile_vectors = [vectors[track.id] for track in profile if track.id in vectors]
+        if profile_vectors:
+            # Recent plays count for more than older ones
+            weights = np.linspace(1.0, 0.5, len(profile_vectors), dtype=np.float32)
+            centroid = weights @ np.stack(profile_vectors)
+            centroid /= np.linalg.norm(centroid) or 1.0
+            dims = len(centroid)
+            matrix = np.stack([vectors.get(track.id, np.zeros(dims, dtype=np.float32)) for track in candidates])
+            norms = np.linalg.norm(matrix, axis=1)
+            norms[norms == 0] = 1.0
+            scores += (matrix @ centroid) / norms
+
+        vocabulary: Dict[str, int] = {}
+        for track in profile:
+            for name in genres.get(track.artist_id, ()):
+                vocabulary.setdefault(name, len(vocabulary))
+        if vocabulary:
+            taste = np.zeros(len(vocabulary), dtype=np.float32)
+            for track in profile:
+                for name in genres.get(track.artist_id, ()):
+                    taste[vocabulary[name]] += 1
+            taste /= taste.max()
+            membership = np.zeros((count, len(vocabulary)), dtype=np.float32)
+            for row, track in enumerate(candidates):
+                for name in genres.get(track.artist_id, ()):
+                    column = vocabulary.get(name)
+                    if column is not None:
+                        membership[row, column] = 1.0
+            matched = membership.sum(axis=1)
+            scores += self.GENRE_WEIGHT * (membership @ taste) / np.maximum(matched, 1.0)
+        return scores
+
+    async def _recommend(self, user_id: int, genre: Optional[str], limit: int) -> List[TrackSnapshot]:
+        profile = await self._profile(user_id)
+        candidates = await self._candidates(user_id, profile, genre)
+        if not candidates:
+            return []
+
+        tracks = profile + candidates
+        vectors, genres = await asyncio.gather(
+            self.features.track_vectors(user_id, (track.id for track in tracks if track.id)),
+            self.features.artist_genres(user_id, (track.artist_id for track in tracks if track.artist_id))
+        )
+        scores = self._score(profile, candidates, vectors, genres)
+        order = np.argsort(-scores, kind='stable')[:limit]
+        return [candidates[index] for index in order]
+
+    async def recommend(self, user_id: int, genre: Optional[str] = None, limit: int = 10) -> List[TrackSnapshot]:
+        """Recommended tracks for a user, best first"""
+        # Keyed by the play count so a new play invalidates the result
+        key = (user_id, genre, limit, self.spotify.history.play_count(user_id))
+        return await self.results.get(key, lambda: self._recommend(user_id, genre, limit))
+
+    def close(self):
+        self.candidates.close()
+        self.results.close()
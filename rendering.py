@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+import discord
+
+from models import ArtistSnapshot, PlaybackSnapshot, TrackSnapshot
+
+
+def create_progress_bar(progress_ms: int, duration_ms: int) -> tuple[str, str, str]:
+    """Create a progress bar with timestamps"""
+    progress_percent = (progress_ms / duration_ms) if duration_ms > 0 else 0
+    bar_length = 20
+    filled_length = int(progress_percent * bar_length)
+    bar = '¦' * filled_length + '¦' * (bar_length - filled_length)
+    current_time = f"{progress_ms // 60000}:{(progress_ms // 1000 % 60):02d}"
+    total_time = f"{duration_ms // 60000}:{(duration_ms // 1000 % 60):02d}"
+    return bar, current_time, total_time
+
+
+class NowPlayingRenderer:
+    """Builds Now Playing embeds for the monitor, live displays and commands
+
+    Static track fields come from the shared TrackSnapshot, so a render
+    only formats the progress field. Every render also returns a digest
+    of the visible content that callers compare to skip edits that would
+    change nothing.
+    """
+    def render(self, playback: PlaybackSnapshot) -> Tuple[discord.Embed, str]:
+        """Build the embed for a playback state and the digest of what it shows"""
+        track = playback.track
+        embed = discord.Embed(
+            title="Now Playing",
+            color=discord.Color.green(),
+            timestamp=datetime.now(timezone.utc)
+        )
+        
+        embed.add_field(name="Track", value=f"**{track.name}**", inline=False)
+        embed.add_field(name="Artist", value=track.artist, inline=True)
+        embed.add_field(name="Album", value=track.album, inline=True)
+        
+        progress_text = ''
+        if playback.progress_ms is not None:
+            bar, current_time, total_time = create_progress_bar(playback.progress_ms, track.duration_ms)
+            progress_text = f"`{bar}` {current_time}/{total_time}"
+            embed.add_field(name="Progress", value=progress_text, inline=False)
+        
+        if track.thumbnail:
+            embed.set_thumbnail(url=track.thumbnail)
+        
+        return embed, f"{track.digest}:{progress_text}"
+
+
+def render_stats_page(label: str, top_tracks: List[TrackSnapshot], top_artists: List[ArtistSnapshot]) -> discord.Embed:
+    """Build one page of the /stats dashboard for a single time range"""
+    embed = discord.Embed(
+        title="Your Spotify Statistics",
+        description=label,
+        color=discord.Color.green(),
+        timestamp=datetime.now(timezone.utc)
+    )
+    
+    tracks_text = "".join(
+        f"{i}. {track.name} by {track.artist}\n" for i, track in enumerate(top_tracks, 1)
+    )
+    embed.add_field(name="Your Top Tracks", value=tracks_text or "No tracks found", inline=False)
+    
+    artists_text = "".join(f"{i}. {artist.name}\n" for i, artist in enumerate(top_artists, 1))
+    embed.add_field(name="Your Top Artists", value=artists_text or "No artists found", inline=False)
+    return embed
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import POLL_LAG_SECONDS
+
+logger = logging.getLogger('SpotifyBot.PollScheduler')
+
+
+class PollScheduler:
+    """Polls many users from a single task using a time-ordered heap
+
+    Each user has exactly one entry in the heap. The runner pops entries as
+    they come due and hands them to the poll callback, never running more
+    than ``max_in_flight`` polls at once. The callback returns the delay
+    until that user's next poll, or None to use the default interval.
+    Only the default interval is jittered; returned delays are kept as
+    they are so polls timed to a track's end are not moved before it.
+    """
+    def __init__(
+        self,
+        poll: Callable[[int], Awaitable[Optional[float]]],
+        interval: float = 10.0,
+        jitter: float = 0.2,
+        max_in_flight: int = 8,
+        stats_interval: float = 300.0,
+        name: str = 'Poll scheduler'
+    ):
+        self._poll = poll
+        self.name = name
+        self.interval = interval
+        self.jitter = jitter
+        self.max_in_flight = max_in_flight
+        self.stats_interval = stats_interval
+        self._heap: List[Tuple[float, int, int]] = []
+        # user_id -> sequence number of that user's live heap entry
+        self._entries: Dict[int, int] = {}
+        self._in_flight: Dict[int, asyncio.Task] = {}
+        self._counter = itertools.count()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        # Metrics
+        self.polls_total = 0
+        self.poll_errors = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_avg = 0.0
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of users waiting in the heap"""
+        return len(self._entries) - len(self._in_flight)
+
+    @property
+    def in_flight(self) -> int:
+        """Number of polls currently running"""
+        return len(self._in_flight)
+
+    def _jittered(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def schedule(self, user_id: int, delay: Optional[float] = None):
+        """Add a user or move their next poll, replacing any pending entry
+
+        Without a delay the first poll lands at a random point within one
+        interval, so users added together do not poll in lockstep.
+        """
+        if delay is None:
+            delay = random.uniform(0, self.interval)
+        loop = asyncio.get_running_loop()
+        seq = next(self._counter)
+        self._entries[user_id] = seq
+        heapq.heappush(self._heap, (loop.time() + delay, seq, user_id))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def remove(self, user_id: int):
+        """Stop polling a user; stale heap entries are skipped lazily"""
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Forget every user"""
+        self._entries.clear()
+        self._heap.clear()
+
+    def start(self):
+        """Start the runner task if it is not already running"""
+        if self._runner and not self._runner.done():
+            return
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._wakeup = asyncio.Event()
+        self._runner = asyncio.create_task(self._run())
+        logger.info(f"{self.name} started (max {self.max_in_flight} in flight)")
+
+    async def stop(self):
+        """Cancel the runner and any polls in flight"""
+        tasks = list(self._in_flight.values())
+        if self._runner:
+            tasks.append(self._runner)
+            self._runner = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._in_flight.clear()
+
+    def stats(self) -> dict:
+        """Snapshot of the scheduler metrics"""
+        return {
+            'users': len(self._entries),
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'polls_total': self.polls_total,
+            'poll_errors': self.poll_errors,
+            'lag_last': self.lag_last,
+            'lag_avg': self.lag_avg,
+            'lag_max': self.lag_max,
+        }
+
+    def _record_lag(self, lag: float):
+        POLL_LAG_SECONDS.observe(lag, scheduler=self.name)
+        self.lag_last = lag
+        self.lag_max = max(self.lag_max, lag)
+        # Exponentially weighted so the average follows recent load
+        self.lag_avg += 0.05 * (lag - self.lag_avg)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_stats = loop.time() + self.stats_interval
+        while True:
+            now = loop.time()
+            if now >= next_stats:
+                next_stats = now + self.stats_interval
+                logger.info(
+                    f"{self.name}: {len(self._entries)} users, {self.in_flight} in flight, "
+                    f"lag avg {self.lag_avg:.2f}s max {self.lag_max:.2f}s"
+                )
+                self.lag_max = 0.0
+
+            # Discard entries for removed or rescheduled users
+            while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][1]:
+                heapq.heappop(self._heap)
+
+            self._wakeup.clear()
+            if not self._heap:
+                timeout = next_stats - now
+            else:
+                timeout = self._heap[0][0] - now
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._semaphore.acquire()
+            if not self._heap:
+                self._semaphore.release()
+                continue
+            due, seq, user_id = heapq.heappop(self._heap)
+            if self._entries.get(user_id) != seq or user_id in self._in_flight:
+                # Removed while we waited, or a previous poll is still running
+                self._semaphore.release()
+                if self._entries.get(user_id) == seq:
+                    heapq.heappush(self._heap, (loop.time() + 1.0, seq, user_id))
+                continue
+            self._record_lag(loop.time() - due)
+            self._in_flight[user_id] = asyncio.create_task(self._poll_one(user_id, seq))
+
+    async def _poll_one(self, user_id: int, seq: int):
+        delay = None
+        try:
+            delay = await self._poll(user_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.poll_errors += 1
+            logger.error(f"Error in {self.name.lower()} for user {user_id}: {e}")
+        finally:
+            self.polls_total += 1
+            self._in_flight.pop(user_id, None)
+            self._semaphore.release()
+
+        # Only requeue if nobody removed or rescheduled the user meanwhile
+        if self._entries.get(user_id) == seq:
+            self.schedule(user_id, delay if delay is not None else self._jittered(self.interval))
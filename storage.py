@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from models import ArtistSnapshot, PlaybackSnapshot, TrackSnapshot
+
+logger = logging.getLogger('SpotifyBot.Storage')
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a SQLite database in WAL mode for use from worker threads"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL keeps the database consistent after a crash with NORMAL syncing
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class UserStore:
+    """Crash-safe registry of monitored users
+
+    All rows are loaded in one query at startup and kept in memory.
+    Updates only touch memory and mark the user dirty; a background task
+    writes dirty rows in a single transaction every few seconds.
+    """
+    def __init__(self, path: str, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.users: Dict[int, dict] = {}
+        self._dirty: Set[int] = set()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id INTEGER PRIMARY KEY,"
+            " monitor_enabled INTEGER NOT NULL DEFAULT 0,"
+            " last_track_id TEXT,"
+            " updated_at REAL NOT NULL"
+            ")"
+        )
+        rows = self._conn.execute(
+            "SELECT user_id, monitor_enabled, last_track_id, updated_at FROM users"
+        ).fetchall()
+        for user_id, monitor_enabled, last_track_id, updated_at in rows:
+            self.users[user_id] = {
+                'monitor_enabled': bool(monitor_enabled),
+                'last_track_id': last_track_id,
+                'updated_at': updated_at,
+            }
+
+    async def load(self) -> Dict[int, dict]:
+        """Open the database and load every user record"""
+        await asyncio.get_running_loop().run_in_executor(None, self._open)
+        self._flusher = asyncio.create_task(self._flush_periodically())
+        logger.info(f"Loaded {len(self.users)} users from {self.path}")
+        return self.users
+
+    def get(self, user_id: int) -> Optional[dict]:
+        return self.users.get(user_id)
+
+    def update(self, user_id: int, **fields):
+        """Change a user's record; the write happens on the next flush"""
+        record = self.users.setdefault(user_id, {
+            'monitor_enabled': False,
+            'last_track_id': None,
+        })
+        if all(record.get(key) == value for key, value in fields.items()):
+            return
+        record.update(fields)
+        record['updated_at'] = time.time()
+        self._dirty.add(user_id)
+
+    def _write(self, rows: list):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO users (user_id, monitor_enabled, last_track_id, updated_at)"
+                    " VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET"
+                    " monitor_enabled=excluded.monitor_enabled,"
+                    " last_track_id=excluded.last_track_id,"
+                    " updated_at=excluded.updated_at",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        """Write all dirty records in one transaction"""
+        if not self._dirty or self._conn is None:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = [
+            (
+                user_id,
+                int(self.users[user_id]['monitor_enabled']),
+                self.users[user_id]['last_track_id'],
+                self.users[user_id]['updated_at'],
+            )
+            for user_id in dirty
+        ]
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, rows)
+        except Exception as e:
+            self._dirty |= dirty
+            logger.error(f"Error saving {len(rows)} user records: {e}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        """Flush outstanding changes and close the database"""
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class TokenStore:
+    """Indexed store of Spotify tokens, one row per Discord user
+
+    Every token is loaded into memory at startup so reads never touch
+    the disk. Saves are written through immediately, each in its own
+    transaction, and are safe to call from worker threads.
+    """
+    def __init__(self, path: str, legacy_dir: Optional[Path] = None):
+        self.path = path
+        self.legacy_dir = legacy_dir
+        self.tokens: Dict[int, dict] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.tokens
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            " user_id INTEGER PRIMARY KEY,"
+            " token_info TEXT NOT NULL,"
+            " expires_at INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL"
+            ")"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at)")
+        for user_id, token_info in self._conn.execute("SELECT user_id, token_info FROM tokens"):
+            self.tokens[user_id] = json.loads(token_info)
+        if self.legacy_dir:
+            self._migrate_cache_files()
+
+    def _migrate_cache_files(self):
+        """Import spotipy cache-<user_id> files and rename them out of the way"""
+        migrated = []
+        rows = []
+        for cache_path in self.legacy_dir.glob('cache-*'):
+            user_id = cache_path.name[len('cache-'):]
+            if not user_id.isdigit():
+                continue
+            try:
+                token_info = json.loads(cache_path.read_text())
+            except (OSError, ValueError) as e:
+                logger.error(f"Skipping unreadable token cache {cache_path}: {e}")
+                continue
+            if int(user_id) not in self.tokens:
+                self.tokens[int(user_id)] = token_info
+                rows.append((int(user_id), json.dumps(token_info), token_info['expires_at'], time.time()))
+            migrated.append(cache_path)
+        if not migrated:
+            return
+
+        self._write_many(rows)
+        for cache_path in migrated:
+            cache_path.rename(cache_path.with_name(cache_path.name + '.migrated'))
+        logger.info(f"Migrated {len(rows)} token cache files into {self.path}")
+
+    def _write_many(self, rows: list):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO tokens (user_id, token_info, expires_at, updated_at)"
+                    " VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET"
+                    " token_info=excluded.token_info,"
+                    " expires_at=excluded.expires_at,"
+                    " updated_at=excluded.updated_at",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def load(self) -> Dict[int, dict]:
+        """Open the database, migrate old cache files and load every token"""
+        await asyncio.get_running_loop().run_in_executor(None, self._open)
+        logger.info(f"Loaded {len(self.tokens)} Spotify tokens from {self.path}")
+        return self.tokens
+
+    def get(self, user_id: int) -> Optional[dict]:
+        return self.tokens.get(user_id)
+
+    def reload(self, user_id: int) -> Optional[dict]:
+        """Re-read a user's token, picking up saves made by another process"""
+        with self._lock:
+            row = self._conn.execute("SELECT token_info FROM tokens WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            self.tokens.pop(user_id, None)
+            return None
+        self.tokens[user_id] = json.loads(row[0])
+        return self.tokens[user_id]
+
+    def save(self, user_id: int, token_info: dict):
+        """Replace a user's token atomically"""
+        self._write_many([(user_id, json.dumps(token_info), token_info['expires_at'], time.time())])
+        self.tokens[user_id] = token_info
+
+    def delete(self, user_id: int):
+        """Forget a user's token"""
+        self.tokens.pop(user_id, None)
+        with self._lock:
+            self._conn.execute("DELETE FROM tokens WHERE user_id = ?", (user_id,))
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class _OpenPlay:
+    """A play the monitor is still watching"""
+    __slots__ = ('track', 'played_at', 'first_progress_ms', 'progress_ms', 'seen_at', 'is_playing')
+
+    def __init__(self, track: TrackSnapshot, progress_ms: int, seen_at: float, is_playing: bool):
+        self.track = track
+        self.played_at = seen_at - progress_ms / 1000
+        self.first_progress_ms = progress_ms
+        self.progress_ms = progress_ms
+        self.seen_at = seen_at
+        self.is_playing = is_playing
+
+    def listened_ms(self, now: float) -> int:
+        """Estimate how much of the track was heard up to now"""
+        progress = self.progress_ms
+        if self.is_playing:
+            progress += (now - self.seen_at) * 1000
+        return int(max(0, min(progress, self.track.duration_ms) - self.first_progress_ms))
+
+
+class HistoryStore:
+    """Append-only history of plays seen by the track monitor
+
+    The monitor reports every poll through observe(). A play is written
+    once it ends, together with an estimate of how long it was listened
+    to. Rows are buffered and inserted in one transaction every few
+    seconds. Track details live in their own table so each play row is
+    only a few integers and a track id, and plays are indexed by
+    (user_id, played_at) so windowed queries only read one user's range.
+    """
+    # A track that jumps back by more than this is treated as a new play
+    REPLAY_THRESHOLD_MS = 10000
+
+    def __init__(self, path: str, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._open_plays: Dict[int, _OpenPlay] = {}
+        # Plays recorded per user since startup, for invalidating derived caches
+        self._play_counts: Dict[int, int] = {}
+        self._pending: List[Tuple[int, _OpenPlay, int]] = []
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def _open(self):
+        self._conn = connect(self.path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            " track_id TEXT PRIMARY KEY,"
+            " uri TEXT,"
+            " name TEXT NOT NULL,"
+            " artist TEXT NOT NULL,"
+            " artist_id TEXT,"
+            " album TEXT NOT NULL,"
+            " duration_ms INTEGER NOT NULL"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS plays ("
+            " user_id INTEGER NOT NULL,"
+            " played_at REAL NOT NULL,"
+            " track_id TEXT NOT NULL,"
+            " listened_ms INTEGER NOT NULL"
+            ")"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS plays_user_time ON plays (user_id, played_at)")
+
+    async def load(self):
+        """Open the database and start the background writer"""
+        await asyncio.get_running_loop().run_in_executor(None, self._open)
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    def observe(self, user_id: int, playback: Optional[PlaybackSnapshot], now: Optional[float] = None):
+        """Update the user's current play from a poll, recording it once it ends"""
+        now = time.time() if now is None else now
+        current = self._open_plays.get(user_id)
+        track = playback.track if playback else None
+        progress_ms = playback.progress_ms if playback else None
+        
+        if current is not None:
+            same_play = (
+                track is not None
+                and track.id == current.track.id
+                and progress_ms is not None
+                and progress_ms >= current.progress_ms - self.REPLAY_THRESHOLD_MS
+            )
+            if same_play:
+                current.progress_ms = progress_ms
+                current.seen_at = now
+                current.is_playing = playback.is_playing
+                return
+            self.finish(user_id, now)
+        
+        if track is not None and track.id and progress_ms is not None:
+            self._open_plays[user_id] = _OpenPlay(track, progress_ms, now, playback.is_playing)
+
+    def finish(self, user_id: int, now: Optional[float] = None):
+        """Record the user's current play, e.g. when monitoring stops"""
+        current = self._open_plays.pop(user_id, None)
+        if current is not None:
+            now = time.time() if now is None else now
+            self._pending.append((user_id, current, current.listened_ms(now)))
+            self.count_play(user_id)
+
+    def count_play(self, user_id: int):
+        """Note a new play, including ones recorded by another process"""
+        self._play_counts[user_id] = self._play_counts.get(user_id, 0) + 1
+
+    def play_count(self, user_id: int) -> int:
+        """Number of plays recorded for the user since startup"""
+        return self._play_counts.get(user_id, 0)
+
+    def _write(self, plays: list):
+        tracks = {play.track.id: play.track for _, play, _ in plays}
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO tracks"
+                    " (track_id, uri, name, artist, artist_id, album, duration_ms)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (track.id, track.uri, track.name, track.artist, track.artist_id,
+                         track.album, track.duration_ms)
+                        for track in tracks.values()
+                    ]
+                )
+                self._conn.executemany(
+                    "INSERT INTO plays (user_id, played_at, track_id, listened_ms) VALUES (?, ?, ?, ?)",
+                    [(user_id, play.played_at, play.track.id, listened_ms) for user_id, play, listened_ms in plays]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        """Write all finished plays in one transaction"""
+        if not self._pending or self._conn is None:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, pending)
+        except Exception as e:
+            self._pending = pending + self._pending
+            logger.error(f"Error saving {len(pending)} plays: {e}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _query(self, sql: str, params: tuple) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def _fetch(self, sql: str, params: tuple) -> list:
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(None, self._query, sql, params)
+
+    async def top_tracks(self, user_id: int, since: float, limit: int = 10) -> List[TrackSnapshot]:
+        """Tracks the user listened to longest since a unix time"""
+        rows = await self._fetch(
+            "SELECT t.track_id, t.uri, t.name, t.artist, t.album, t.duration_ms, t.artist_id"
+            " FROM (SELECT track_id, SUM(listened_ms) AS listened FROM plays"
+            "       WHERE user_id = ? AND played_at >= ? GROUP BY track_id) p"
+            " JOIN tracks t ON t.track_id = p.track_id"
+            " ORDER BY p.listened DESC LIMIT ?",
+            (user_id, since, limit)
+        )
+        return [
+            TrackSnapshot(track_id, uri, name, artist, album, None, duration_ms, artist_id)
+            for track_id, uri, name, artist, album, duration_ms, artist_id in rows
+        ]
+
+    async def top_artists(self, user_id: int, since: float, limit: int = 10) -> List[ArtistSnapshot]:
+        """Artists the user listened to longest since a unix time"""
+        rows = await self._fetch(
+            "SELECT MAX(t.artist_id), t.artist"
+            " FROM plays p JOIN tracks t ON t.track_id = p.track_id"
+            " WHERE p.user_id = ? AND p.played_at >= ?"
+            " GROUP BY t.artist ORDER BY SUM(p.listened_ms) DESC LIMIT ?",
+            (user_id, since, limit)
+        )
+        return [ArtistSnapshot(artist_id, artist, ()) for artist_id, artist in rows]
+
+    async def recent_tracks(self, user_id: int, limit: int = 50) -> List[TrackSnapshot]:
+        """The user's most recent distinct tracks, newest first"""
+        rows = await self._fetch(
+            "SELECT t.track_id, t.uri, t.name, t.artist, t.album, t.duration_ms, t.artist_id"
+            " FROM (SELECT track_id, MAX(played_at) AS last_played FROM"
+            "       (SELECT track_id, played_at FROM plays WHERE user_id = ?"
+            "        ORDER BY played_at DESC LIMIT ?)"
+            "       GROUP BY track_id) p"
+            " JOIN tracks t ON t.track_id = p.track_id"
+            " ORDER BY p.last_played DESC",
+            (user_id, limit * 4)
+        )
+        return [
+            TrackSnapshot(track_id, uri, name, artist, album, None, duration_ms, artist_id)
+            for track_id, uri, name, artist, album, duration_ms, artist_id in rows[:limit]
+        ]
+
+    async def close(self):
+        """Record open plays, flush them and close the database"""
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        for user_id in list(self._open_plays):
+            self.finish(user_id)
+        await self.flush()
+        if self._conn:
+            self._conn.close()
+            self._conn = None
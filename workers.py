@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from metrics import REGISTRY
+from models import PlaybackSnapshot, TrackCatalog, TrackSnapshot
+
+logger = logging.getLogger('SpotifyBot.Workers')
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping user ids to worker indexes
+
+    Each worker owns many points on the ring so users spread evenly, and
+    changing the number of workers only moves the users whose points
+    change hands.
+    """
+    def __init__(self, nodes: Iterable[int], replicas: int = 100):
+        points = sorted((_hash(f"{node}:{replica}"), node) for node in nodes for replica in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, user_id: int) -> int:
+        index = bisect.bisect(self._keys, _hash(str(user_id))) % len(self._keys)
+        return self._nodes[index]
+
+
+def encode_message(*fields) -> bytes:
+    """One IPC message: a JSON array on its own line"""
+    return json.dumps(fields, separators=(',', ':')).encode() + b'\n'
+
+
+def encode_playback(playback: PlaybackSnapshot) -> list:
+    """Flatten a playback snapshot into the fields of a track event"""
+    track = playback.track
+    return [
+        [track.id, track.uri, track.name, track.artist, track.album,
+         track.thumbnail, track.duration_ms, track.artist_id],
+        playback.is_playing,
+        playback.progress_ms,
+        playback.volume_percent,
+    ]
+
+
+def decode_playback(fields: list, tracks: TrackCatalog) -> PlaybackSnapshot:
+    """Rebuild a playback snapshot from a track event, sharing cached tracks"""
+    track_fields, is_playing, progress_ms, volume_percent = fields
+    return PlaybackSnapshot(tracks.add(TrackSnapshot(*track_fields)), is_playing, progress_ms, volume_percent)
+
+
+def _run_worker(index: int, path: str, config):
+    # Imported here because monitor_worker imports the bot module, which imports this one
+    import monitor_worker
+    monitor_worker.run(index, path, config)
+
+
+class MonitorPool:
+    """Runs the track monitor in worker processes
+
+    Users are spread across workers by consistent hashing of their id.
+    The pool stands in for the in-process PollScheduler: schedule() and
+    remove() are forwarded to the worker that owns the user, and workers
+    report track changes back over a Unix socket as compact JSON lines,
+    so no broker is needed. Their Spotify and poll lag metrics are
+    merged into this process's registry with each stats report. Workers that exit are restarted and given
+    their users again.
+    """
+    STATS_INTERVAL = 5
+    RESTART_DELAY = 5
+
+    def __init__(
+        self,
+        count: int,
+        path: str,
+        config,
+        on_track_change: Callable[[int, PlaybackSnapshot], None],
+        on_reauth: Callable[[int], Awaitable[None]],
+        last_tracks: Dict[int, str],
+        tracks: TrackCatalog,
+        interval: float = 10.0,
+        rate: float = 10.0
+    ):
+        self.count = count
+        self.path = path
+        self.config = config
+        self.on_track_change = on_track_change
+        self.on_reauth = on_reauth
+        self.last_tracks = last_tracks
+        self.tracks = tracks
+        self.interval = interval
+        # Spotify requests per second each worker may make
+        self.rate = rate
+        self.ring = HashRing(range(count))
+        # user_id -> index of the worker polling them
+        self.users: Dict[int, int] = {}
+        self._writers: Dict[int, asyncio.StreamWriter] = {}
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._worker_stats: Dict[int, dict] = {}
+        self._tasks: set = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._runner: Optional[asyncio.Task] = None
+        self.events = 0
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.users
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    @property
+    def queue_depth(self) -> int:
+        """Users waiting for their next poll across all workers"""
+        return sum(stats.get('queue_depth', 0) for stats in self._worker_stats.values())
+
+    @property
+    def in_flight(self) -> int:
+        """Polls running across all workers"""
+        return sum(stats.get('in_flight', 0) for stats in self._worker_stats.values())
+
+    def schedule(self, user_id: int, delay: Optional[float] = None):
+        """Add a user, or move their next poll, on the worker that owns them"""
+        worker = self.ring.node_for(user_id)
+        self.users[user_id] = worker
+        self._send(worker, 'watch', user_id, self.last_tracks.get(user_id), delay)
+
+    def remove(self, user_id: int):
+        """Stop polling a user"""
+        worker = self.users.pop(user_id, None)
+        if worker is not None:
+            self._send(worker, 'unwatch', user_id)
+
+    def _send(self, worker: int, *fields):
+        writer = self._writers.get(worker)
+        # A worker that is not connected gets all its users when it says hello
+        if writer is not None and not writer.is_closing():
+            writer.write(encode_message(*fields))
+
+    def start(self):
+        """Start the socket server and the workers if they are not running"""
+        if self._runner and not self._runner.done():
+            return
+        self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        path = Path(self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            path.unlink()
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        logger.info(f"Starting {self.count} monitor workers on {self.path}")
+        context = multiprocessing.get_context('spawn')
+        while True:
+            for index in range(self.count):
+                process = self._processes.get(index)
+                if process is None or not process.is_alive():
+                    if process is not None:
+                        logger.warning(f"Monitor worker {index} exited with code {process.exitcode}, restarting")
+                    process = context.Process(
+                        target=_run_worker,
+                        args=(index, self.path, self.config),
+                        name=f'monitor-worker-{index}',
+                        daemon=True
+                    )
+                    process.start()
+                    self._processes[index] = process
+            await asyncio.sleep(self.RESTART_DELAY)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                kind, *fields = json.loads(line)
+                if kind == 'hello':
+                    worker = fields[0]
+                    self._writers[worker] = writer
+                    self._assign(worker)
+                elif kind == 'track':
+                    user_id, event = fields[0], fields[1:]
+                    self.events += 1
+                    if user_id in self.users:
+                        self.on_track_change(user_id, decode_playback(event, self.tracks))
+                elif kind == 'reauth':
+                    task = asyncio.create_task(self.on_reauth(fields[0]))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                elif kind == 'stats':
+                    self._worker_stats[worker] = fields[0]
+                    # Latency histograms and error counts observed in the worker
+                    REGISTRY.merge(fields[1])
+        except Exception as e:
+            logger.error(f"Error reading from monitor worker {worker}: {e}")
+        finally:
+            if worker is not None and self._writers.get(worker) is writer:
+                del self._writers[worker]
+                self._worker_stats.pop(worker, None)
+            writer.close()
+
+    def _assign(self, worker: int):
+        """Hand a newly connected worker every user it owns"""
+        users = [user_id for user_id, owner in self.users.items() if owner == worker]
+        # Spread first polls so a (re)started worker fits in its rate budget
+        window = max(self.interval, 2 * len(users) / self.rate)
+        for user_id in users:
+            self._send(worker, 'watch', user_id, self.last_tracks.get(user_id), random.uniform(0, window))
+        logger.info(f"Monitor worker {worker} connected with {len(users)} users")
+
+    async def stop(self):
+        """Stop the workers and the socket server"""
+        if self._runner:
+            self._runner.cancel()
+            self._runner = None
+        for task in self._tasks:
+            task.cancel()
+        # Workers exit once their connection closes
+        for writer in list(self._writers.values()):
+            writer.close()
+        self._writers.clear()
+        loop = asyncio.get_running_loop()
+        for process in self._processes.values():
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        self._processes.clear()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            Path(self.path).unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        """Monitor metrics summed over the workers"""
+        totals: Dict[str, float] = {'users': len(self.users), 'workers': len(self._writers), 'events': self.events}
+        for stats in self._worker_stats.values():
+            for name in ('queue_depth', 'in_flight', 'polls_total', 'poll_errors'):
+                totals[name] = totals.get(name, 0) + stats.get(name, 0)
+            for name in ('lag_last', 'lag_avg', 'lag_max'):
+                totals[name] = max(totals.get(name, 0.0), stats.get(name, 0.0))
+        return totals